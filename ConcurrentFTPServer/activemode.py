@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+"""
+Author: Andrea Mathew
+Created: 10/24/19
+activemode.py
+Description: Parses PORT/EPRT addresses and opens active mode data connections with bounded timeouts
+"""
+import socket
+import ipaddress
+
+# EPRT network protocol numbers, RFC 2428
+EPRTFAMILIES = {"1": socket.AF_INET, "2": socket.AF_INET6}
+
+
+def parseport(argument):
+    """
+    Parses the argument of PORT
+    :param argument: "h1,h2,h3,h4,p1,p2"
+    :return: (family, host, port)
+    """
+    numbers = [int(x) for x in argument.strip().split(",")]
+    if len(numbers) != 6 or any(x < 0 or x > 255 for x in numbers):
+        raise ValueError("bad PORT argument: %s" % argument.strip())
+    port = numbers[4] * 256 + numbers[5]
+    if port == 0:
+        raise ValueError("bad PORT argument: %s" % argument.strip())
+    return (socket.AF_INET, "%d.%d.%d.%d" % tuple(numbers[:4]), port)
+
+
+def parseeprt(argument):
+    """
+    Parses the argument of EPRT, such as "|1|132.235.1.2|6275|" or "|2|1080::8:800:200C:417A|5282|"
+    :param argument: delimiter, protocol, address and port
+    :return: (family, host, port), family is None for a protocol other than 1 (IPv4) or 2 (IPv6)
+    """
+    argument = argument.strip()
+    if argument == "":
+        raise ValueError("empty EPRT argument")
+    fields = argument.split(argument[0])
+    if len(fields) != 5 or fields[0] != "" or fields[4] != "":
+        raise ValueError("bad EPRT argument: %s" % argument)
+    family = EPRTFAMILIES.get(fields[1])
+    host = fields[2]
+    port = int(fields[3])
+    if not 0 < port < 65536:
+        raise ValueError("bad EPRT port: %s" % fields[3])
+    if family is not None:
+        try:
+            socket.inet_pton(family, host)
+        except OSError:
+            raise ValueError("bad EPRT address: %s" % host)
+    return (family, host, port)
+
+
+def samehost(first, second):
+    """
+    Compares two addresses, an IPv4-mapped IPv6 address equals its IPv4 address
+    :param first: address string
+    :param second: address string
+    :return: True if both are the same host
+    """
+    addresses = []
+    for address in (first, second):
+        address = ipaddress.ip_address(address.split("%")[0])
+        if address.version == 6 and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+        addresses.append(address)
+    return addresses[0] == addresses[1]
+
+
+class ActiveConnector:
+    """
+    Opens and tunes data connections for all sessions
+    Every data socket gets the configured buffer sizes and TCP_NODELAY, and active mode connects
+    give up after the connect timeout instead of holding the session on an unreachable client
+    """
+
+    def __init__(self, connecttimeout=10.0, sendbuffer=0, receivebuffer=0):
+        """
+        Create connector
+        :param connecttimeout: seconds an active mode connect may take, 0 = no limit
+        :param sendbuffer: SO_SNDBUF for data sockets, 0 keeps the kernel default
+        :param receivebuffer: SO_RCVBUF for data sockets, 0 keeps the kernel default
+        """
+        self.connecttimeout = connecttimeout
+        self.sendbuffer = sendbuffer
+        self.receivebuffer = receivebuffer
+
+    def tune(self, dsocket):
+        """
+        Applies buffer sizes and TCP_NODELAY, call before connect so the receive window is scaled to the buffer
+        :param dsocket: data socket
+        :return: none
+        """
+        if self.sendbuffer > 0:
+            dsocket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sendbuffer)
+        if self.receivebuffer > 0:
+            dsocket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receivebuffer)
+        # the last partial segment of a transfer goes out at once instead of waiting for an ACK
+        dsocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def connect(self, family, host, port, localhost=None):
+        """
+        Connects to the address from PORT or EPRT
+        :param family: socket.AF_INET or socket.AF_INET6
+        :param host: client address
+        :param port: client port
+        :param localhost: local address to connect from, the control connection's address
+        :return: connected data socket
+        """
+        dsocket = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            self.tune(dsocket)
+            if localhost is not None:
+                dsocket.bind((localhost, 0))
+            dsocket.settimeout(self.connecttimeout or None)
+            dsocket.connect((host, port))
+        except (socket.error, OverflowError):
+            dsocket.close()
+            raise
+        return dsocket
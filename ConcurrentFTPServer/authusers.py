@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+"""
+Author: Andrea Mathew
+Created: 10/24/19
+authusers.py
+Description: In memory index of the users in authusers.txt
+"""
+import sys
+import os
+import hmac
+import hashlib
+import threading
+
+# scrypt cost for new hashes, about 16 MB and 50 ms per check, each hash stores its own cost
+SCRYPTN = 16384
+SCRYPTR = 8
+SCRYPTP = 1
+# most memory a stored cost may ask scrypt for
+SCRYPTMAXMEM = 268435456
+
+
+class CredentialStore:
+    """
+    Holds authusers.txt as a dict keyed by exact username
+    The file is read again only when its mtime, size or inode changes
+    A successful check of a hashed password is remembered per (user, stored hash), so logins after
+    the first one cost an HMAC instead of a full scrypt run
+    """
+
+    def __init__(self, filename="authusers.txt"):
+        """
+        Create credential store, the file is loaded on first use
+        :param filename: file with one <username>:<password> pair per line
+        """
+        self.filename = filename
+        self.credentials = {}
+        self.signature = None
+        self.lock = threading.Lock()
+        # (user, stored hash) -> HMAC of the password that matched, the password itself is never kept
+        self.verified = {}
+        self.secret = os.urandom(32)
+
+    def reload(self):
+        """
+        Reads the file into a new dict and swaps it in, so logins running at the same time see either the old or the new users
+        :return: none
+        """
+        credentials = {}
+        with open(self.filename, "r") as authusersfile:
+            for line in authusersfile:
+                line = line.strip()
+                if line == "" or line.startswith("#") or ":" not in line:
+                    continue
+                (user, password) = line.split(":", 1)
+                credentials[user.strip()] = password.strip()
+        self.credentials = credentials
+        self.verified = {}
+
+    def checkreload(self):
+        """
+        Reloads the file if it changed since it was last read
+        :return: none
+        """
+        try:
+            filestat = os.stat(self.filename)
+        except OSError as e:
+            print(e)
+            return
+        signature = (filestat.st_mtime_ns, filestat.st_size, filestat.st_ino)
+        if signature != self.signature:
+            with self.lock:
+                if signature != self.signature:
+                    self.reload()
+                    self.signature = signature
+
+    def authenticate(self, user, password):
+        """
+        Checks if user and pass are an authorized pair
+        :param user: user name from USER
+        :param password: password from PASS
+        :return: True if the pair is in the file
+        """
+        self.checkreload()
+        stored = self.credentials.get(user)
+        if stored is None:
+            return False
+        if "$" not in stored:
+            return checkpassword(stored, password)
+        key = (user, stored)
+        proof = hmac.new(self.secret, password.encode(), hashlib.sha256).digest()
+        remembered = self.verified.get(key)
+        if remembered is not None and hmac.compare_digest(remembered, proof):
+            return True
+        if not checkpassword(stored, password):
+            return False
+        self.verified[key] = proof
+        return True
+
+
+def hashpassword(password, salt=None, n=SCRYPTN, r=SCRYPTR, p=SCRYPTP):
+    """
+    Builds the salted scrypt form of a password for authusers.txt
+    :param password: plain text password
+    :param salt: salt bytes, random if not given
+    :param n: scrypt CPU and memory cost, a power of 2
+    :param r: scrypt block size
+    :param p: scrypt parallelization
+    :return: scrypt$<n>$<r>$<p>$<salt hex>$<digest hex>
+    """
+    if salt is None:
+        salt = os.urandom(16)
+    digest = hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=SCRYPTMAXMEM, dklen=32)
+    return "scrypt$%d$%d$%d$%s$%s" % (n, r, p, salt.hex(), digest.hex())
+
+
+def legacyhash(password, salt):
+    """
+    Single round salted SHA-256 written by older versions, still accepted so existing files keep working
+    :param password: plain text password
+    :param salt: salt bytes
+    :return: sha256$<salt hex>$<digest hex>
+    """
+    digest = hashlib.sha256(salt + password.encode()).hexdigest()
+    return "sha256$%s$%s" % (salt.hex(), digest)
+
+
+def checkpassword(stored, password):
+    """
+    Compares a password against the stored form, salted hash or plain text
+    :param stored: password field from authusers.txt
+    :param password: password from PASS
+    :return: True if they match
+    """
+    if stored.startswith("scrypt$"):
+        try:
+            (name, n, r, p, salt, digest) = stored.split("$")
+            computed = hashpassword(password, bytes.fromhex(salt), int(n), int(r), int(p))
+        except ValueError:
+            # malformed line or a cost scrypt refuses
+            return False
+        return hmac.compare_digest(computed, stored)
+    if stored.startswith("sha256$"):
+        try:
+            salt = bytes.fromhex(stored.split("$")[1])
+        except ValueError:
+            return False
+        return hmac.compare_digest(legacyhash(password, salt), stored)
+    return hmac.compare_digest(stored.encode(), password.encode())
+
+
+def main():
+    """
+    Prints an authusers.txt line with a salted scrypt password hash
+    :return: none
+    """
+    if len(sys.argv) == 3:
+        print("%s:%s" % (sys.argv[1], hashpassword(sys.argv[2])))
+    else:
+        print("TO RUN: authusers.py <username> <password>")
+
+
+if __name__ == "__main__":
+    main()
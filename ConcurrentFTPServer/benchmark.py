@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+
+"""
+Author: Andrea Mathew
+Created: 10/24/19
+benchmark.py
+Description: Load generator that starts ftpserver.py on loopback and drives concurrent clients against it
+"""
+import os
+import re
+import math
+import sys
+import time
+import socket
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+
+SERVERSCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ftpserver.py")
+BENCHUSER = "bench"
+BENCHPASSWORD = "bench"
+
+
+class BenchClient:
+    """
+    Minimal FTP client that times every command it sends
+    """
+
+    def __init__(self, host, port, stats):
+        """
+        Connect to the server and read the greeting
+        :param host: server address
+        :param port: server control port
+        :param stats: BenchStats the timings are recorded in
+        """
+        self.host = host
+        self.stats = stats
+        self.controlsocket = socket.create_connection((host, port))
+        self.controlfile = self.controlsocket.makefile("rb")
+        self.reply()
+
+    def reply(self):
+        """
+        Reads one reply, multi-line replies included
+        :return: reply text
+        """
+        line = self.controlfile.readline().decode()
+        response = line
+        if line[3:4] == "-":
+            while line and not (line[:3] == response[:3] and line[3:4] == " "):
+                line = self.controlfile.readline().decode()
+                response += line
+        if not response:
+            raise ConnectionError("server closed the control connection")
+        return response
+
+    def command(self, command, expect="2"):
+        """
+        Sends a command and waits for its final reply, recording the latency
+        :param command: command line without CRLF
+        :param expect: first digit of the reply that counts as success
+        :return: reply text
+        """
+        start = time.perf_counter()
+        self.controlsocket.sendall((command + "\r\n").encode())
+        response = self.reply()
+        self.stats.latency(command.split()[0], time.perf_counter() - start)
+        if not response.startswith(expect):
+            raise RuntimeError("%s failed: %s" % (command, response.strip()))
+        return response
+
+    def login(self):
+        """
+        Sends USER and PASS, then TYPE I
+        :return: none
+        """
+        self.command("USER " + BENCHUSER, "3")
+        self.command("PASS " + BENCHPASSWORD)
+        self.stats.login(time.perf_counter())
+        self.command("TYPE I")
+
+    def passive(self):
+        """
+        Sends PASV and connects to the port in the reply
+        :return: connected data socket
+        """
+        response = self.command("PASV")
+        numbers = re.search(r"\((\d+),(\d+),(\d+),(\d+),(\d+),(\d+)\)", response).groups()
+        port = int(numbers[4]) * 256 + int(numbers[5])
+        return socket.create_connection((".".join(numbers[:4]), port))
+
+    def transfer(self, command, upload=None):
+        """
+        Runs a data transfer command over a passive connection
+        :param command: LIST, RETR <file> or STOR <file>
+        :param upload: path of the local file to send for STOR
+        :return: number of bytes moved on the data connection
+        """
+        dsocket = self.passive()
+        verb = command.split()[0]
+        start = time.perf_counter()
+        moved = 0
+        try:
+            self.controlsocket.sendall((command + "\r\n").encode())
+            preliminary = self.reply()
+            if not preliminary.startswith("1"):
+                raise RuntimeError("%s failed: %s" % (command, preliminary.strip()))
+            if upload is not None:
+                with open(upload, "rb") as file:
+                    moved = dsocket.sendfile(file)
+                dsocket.shutdown(socket.SHUT_WR)
+            else:
+                buffer = bytearray(1 << 20)
+                while True:
+                    received = dsocket.recv_into(buffer)
+                    if received == 0:
+                        break
+                    moved += received
+        finally:
+            dsocket.close()
+        response = self.reply()
+        elapsed = time.perf_counter() - start
+        self.stats.latency(verb, elapsed)
+        if not response.startswith("2"):
+            raise RuntimeError("%s failed: %s" % (command, response.strip()))
+        self.stats.transfer(verb, moved, elapsed)
+        return moved
+
+    def quit(self):
+        """
+        Sends QUIT and closes the control connection
+        :return: none
+        """
+        try:
+            self.command("QUIT")
+        finally:
+            self.controlsocket.close()
+
+
+class BenchStats:
+    """
+    Latencies, transfer totals and errors collected from every client thread
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.logins = []
+        self.transfers = {}
+        self.errors = []
+
+    def latency(self, verb, seconds):
+        with self.lock:
+            self.latencies.setdefault(verb, []).append(seconds)
+
+    def login(self, finished):
+        with self.lock:
+            self.logins.append(finished)
+
+    def transfer(self, verb, moved, seconds):
+        with self.lock:
+            (total, elapsed) = self.transfers.get(verb, (0, 0.0))
+            self.transfers[verb] = (total + moved, elapsed + seconds)
+
+    def error(self, message):
+        with self.lock:
+            self.errors.append(message)
+
+
+def percentile(values, fraction):
+    """
+    Nearest rank percentile
+    :param values: sorted list of numbers
+    :param fraction: 0.5 for p50, 0.99 for p99
+    :return: value at that rank
+    """
+    index = min(len(values) - 1, max(0, math.ceil(fraction * len(values)) - 1))
+    return values[index]
+
+
+def serverrss(pid):
+    """
+    Reads the resident set size of the server process
+    :param pid: server process id
+    :return: RSS in kB, 0 if it cannot be read
+    """
+    try:
+        with open("/proc/%d/status" % pid, "r") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def writefile(path, size):
+    """
+    Creates a file of random bytes
+    :param path: file to create
+    :param size: size in bytes
+    :return: none
+    """
+    with open(path, "wb") as file:
+        remaining = size
+        while remaining > 0:
+            chunk = min(remaining, 1 << 20)
+            file.write(os.urandom(chunk))
+            remaining -= chunk
+
+
+def setupserverdir(workdir, options):
+    """
+    Writes the config, users and test files the server runs with
+    :param workdir: directory the server is started in
+    :param options: parsed command line options
+    :return: path of the local file uploaded with STOR
+    """
+    with open(os.path.join(workdir, "ftpserver.conf"), "w") as configfile:
+        configfile.write("port_mode = NO\n")
+        configfile.write("pasv_mode = YES\n")
+        configfile.write("server_mode = %s\n" % options.mode)
+        configfile.write("listen_address = 127.0.0.1\n")
+        configfile.write("root_dir = root\n")
+        configfile.write("max_sessions = %d\n" % (options.clients * 2))
+        configfile.write("worker_threads = %d\n" % options.workers)
+        configfile.write("listen_backlog = %d\n" % max(128, options.clients))
+    with open(os.path.join(workdir, "authusers.txt"), "w") as authusersfile:
+        authusersfile.write("%s:%s\n" % (BENCHUSER, BENCHPASSWORD))
+    os.mkdir(os.path.join(workdir, "root"))
+    for x in range(options.listsize):
+        open(os.path.join(workdir, "root", "entry%05d" % x), "w").close()
+    writefile(os.path.join(workdir, "root", "download.bin"), options.size)
+    upload = os.path.join(workdir, "upload.bin")
+    writefile(upload, options.size)
+    return upload
+
+
+def startserver(workdir, port):
+    """
+    Starts ftpserver.py and waits until it accepts connections
+    :param workdir: directory the server is started in
+    :param port: control port
+    :return: server process
+    """
+    server = subprocess.Popen([sys.executable, SERVERSCRIPT, "bench.log", str(port)], cwd=workdir,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("server exited with status %d" % server.returncode)
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return server
+        except socket.error:
+            time.sleep(0.05)
+    server.kill()
+    raise RuntimeError("server did not start listening")
+
+
+def freeport():
+    """
+    :return: a currently unused loopback port
+    """
+    probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    probe.bind(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    return port
+
+
+def runclient(port, options, upload, stats, startbarrier):
+    """
+    One simulated client: login, then LIST, RETR and STOR for every iteration
+    :return: none
+    """
+    startbarrier.wait()
+    try:
+        client = BenchClient("127.0.0.1", port, stats)
+        client.login()
+        for iteration in range(options.iterations):
+            if options.list:
+                client.transfer("LIST")
+            if options.retr:
+                client.transfer("RETR download.bin")
+            if options.stor:
+                client.transfer("STOR upload%d.bin" % threading.get_ident(), upload)
+        client.quit()
+    except Exception as e:
+        stats.error("%s: %s" % (type(e).__name__, e))
+
+
+def report(stats, start, elapsed, peakrss, idlerss):
+    """
+    Prints the benchmark results
+    :return: none
+    """
+    print("elapsed          %.2f s" % elapsed)
+    if stats.logins:
+        # every client logs in once right after the start barrier
+        print("logins/sec       %.1f" % (len(stats.logins) / (max(stats.logins) - start)))
+    print("command latency (ms)")
+    for verb in sorted(stats.latencies):
+        values = sorted(stats.latencies[verb])
+        print("  %-6s n=%-6d p50=%8.2f  p99=%8.2f" % (verb, len(values), percentile(values, 0.5) * 1000,
+                                                      percentile(values, 0.99) * 1000))
+    print("transfer throughput")
+    for verb in sorted(stats.transfers):
+        (total, transfertime) = stats.transfers[verb]
+        print("  %-6s %10.1f MB moved  %8.1f MB/s aggregate  %8.1f MB/s per stream" % (
+            verb, total / 1e6, total / 1e6 / elapsed, total / 1e6 / transfertime))
+    print("server RSS       idle %.1f MB, peak %.1f MB" % (idlerss / 1024, peakrss / 1024))
+    if stats.errors:
+        print("errors           %d, first: %s" % (len(stats.errors), stats.errors[0]))
+
+
+def main():
+    """
+    Parses options, runs the benchmark and prints the report
+    :return: none
+    """
+    parser = argparse.ArgumentParser(description="Load test ftpserver.py on loopback")
+    parser.add_argument("--clients", type=int, default=20, help="concurrent simulated clients")
+    parser.add_argument("--iterations", type=int, default=5, help="LIST/RETR/STOR rounds per client")
+    parser.add_argument("--size", type=int, default=1 << 20, help="bytes per RETR and STOR file")
+    parser.add_argument("--listsize", type=int, default=100, help="entries in the listed directory")
+    parser.add_argument("--mode", choices=["threads", "asyncio"], default="threads", help="server_mode to run")
+    parser.add_argument("--workers", type=int, default=32, help="worker_threads for the server")
+    parser.add_argument("--no-list", dest="list", action="store_false", help="skip LIST")
+    parser.add_argument("--no-retr", dest="retr", action="store_false", help="skip RETR")
+    parser.add_argument("--no-stor", dest="stor", action="store_false", help="skip STOR")
+    options = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="ftpbench")
+    server = None
+    try:
+        upload = setupserverdir(workdir, options)
+        port = freeport()
+        server = startserver(workdir, port)
+        idlerss = serverrss(server.pid)
+        stats = BenchStats()
+        startbarrier = threading.Barrier(options.clients + 1)
+        clients = []
+        for x in range(options.clients):
+            client = threading.Thread(target=runclient, args=(port, options, upload, stats, startbarrier))
+            client.start()
+            clients.append(client)
+        startbarrier.wait()
+        start = time.perf_counter()
+        peakrss = idlerss
+        while any(client.is_alive() for client in clients):
+            peakrss = max(peakrss, serverrss(server.pid))
+            time.sleep(0.05)
+        elapsed = time.perf_counter() - start
+        report(stats, start, elapsed, peakrss, idlerss)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
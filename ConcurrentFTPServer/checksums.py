@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+"""
+Author: Andrea Mathew
+Created: 10/24/19
+checksums.py
+Description: File digests for HASH, XCRC, XMD5 and XSHA256, cached until the file changes
+"""
+import os
+import zlib
+import hashlib
+import threading
+from collections import OrderedDict
+
+# HASH algorithm names, as in FEAT, mapped to hashlib names, CRC32 is computed with zlib
+ALGORITHMS = OrderedDict((("SHA-1", "sha1"), ("SHA-256", "sha256"), ("SHA-512", "sha512"), ("MD5", "md5"),
+                          ("CRC32", None)))
+# bytes hashed per read
+READSIZE = 1048576
+
+
+def filedigest(fd, algorithm):
+    """
+    Digests a whole file, reading it into one reusable buffer
+    :param fd: descriptor of the file, read from offset 0 with pread so the file position is left alone
+    :param algorithm: key of ALGORITHMS
+    :return: lowercase hex digest
+    """
+    buffer = bytearray(READSIZE)
+    view = memoryview(buffer)
+    name = ALGORITHMS[algorithm]
+    digest = hashlib.new(name) if name is not None else None
+    crc = 0
+    offset = 0
+    try:
+        while True:
+            received = os.preadv(fd, [buffer], offset)
+            if received == 0:
+                break
+            if digest is None:
+                crc = zlib.crc32(view[:received], crc)
+            else:
+                # hashlib releases the GIL for large updates, other sessions keep running
+                digest.update(view[:received])
+            offset += received
+    finally:
+        view.release()
+    if digest is None:
+        return "%08x" % crc
+    return digest.hexdigest()
+
+
+class DigestCache:
+    """
+    Digests shared by all sessions, keyed by (device, inode, size, mtime_ns, algorithm)
+    so a file that was written since is digested again, the least recently used entries are dropped
+    """
+
+    def __init__(self, maxentries=4096):
+        """
+        Create cache
+        :param maxentries: digests kept, 0 turns the cache off
+        """
+        self.maxentries = maxentries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def digest(self, fd, algorithm):
+        """
+        Returns the cached digest of an open file or computes and stores it
+        :param fd: descriptor of the open file
+        :param algorithm: key of ALGORITHMS
+        :return: lowercase hex digest
+        """
+        filestat = os.fstat(fd)
+        key = (filestat.st_dev, filestat.st_ino, filestat.st_size, filestat.st_mtime_ns, algorithm)
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                return value
+        value = filedigest(fd, algorithm)
+        after = os.fstat(fd)
+        if self.maxentries > 0 and (after.st_size, after.st_mtime_ns) == (filestat.st_size, filestat.st_mtime_ns):
+            # only kept if the file was not written while it was read
+            with self.lock:
+                self.entries[key] = value
+                while len(self.entries) > self.maxentries:
+                    self.entries.popitem(last=False)
+        return value
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+"""
+Author: Andrea Mathew
+Created: 10/24/19
+compression.py
+Description: Helpers for MODE Z, deflate compressed data connections
+"""
+import os
+import zlib
+
+# files that are already compressed gain nothing from deflate and are sent with level 0
+COMPRESSEDEXTENSIONS = frozenset((".gz", ".tgz", ".bz2", ".tbz2", ".xz", ".txz", ".zst", ".lz4", ".zip", ".7z",
+                                  ".rar", ".jar", ".jpg", ".jpeg", ".png", ".gif", ".webp", ".mp3", ".mp4",
+                                  ".m4a", ".mkv", ".mov", ".avi", ".webm"))
+
+
+def deflatelevel(filename, level):
+    """
+    Picks the compression level for a file
+    :param filename: name of the file sent
+    :param level: configured deflate_level
+    :return: 0 for already compressed files, otherwise level limited to 0-9
+    """
+    if os.path.splitext(filename)[1].lower() in COMPRESSEDEXTENSIONS:
+        return 0
+    return max(0, min(9, level))
+
+
+def compressor(filename, level):
+    """
+    :param filename: name of the file sent
+    :param level: configured deflate_level
+    :return: zlib compression object for one transfer
+    """
+    return zlib.compressobj(deflatelevel(filename, level))
+
+
+def inflate(decompressor, data, limit=262144):
+    """
+    Decompresses received data without letting one small chunk expand into an unbounded buffer
+    :param decompressor: zlib decompression object of the transfer
+    :param data: bytes received from the data connection
+    :param limit: most bytes returned at once
+    :return: generator of decompressed pieces
+    """
+    yield decompressor.decompress(data, limit)
+    while decompressor.unconsumed_tail:
+        yield decompressor.decompress(decompressor.unconsumed_tail, limit)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+"""
+Author: Andrea Mathew
+Created: 10/24/19
+config.py
+Description: Parses ftpserver.conf once into a config object shared by all sessions
+"""
+import signal
+from dataclasses import dataclass, fields
+
+
+@dataclass(frozen=True)
+class ServerConfig:
+    """
+    Values from ftpserver.conf, fields are named after the config keys
+    Immutable so every session can share the same object without locking
+    """
+    port_mode: bool = False
+    pasv_mode: bool = True
+    server_mode: str = "threads"
+    listen_address: str = ""
+    root_dir: str = "."
+    worker_threads: int = 32
+    max_sessions: int = 32
+    listen_backlog: int = 128
+    stor_chunk_size: int = 65536
+    pasv_port_min: int = 0
+    pasv_port_max: int = 0
+    pasv_timeout: float = 30.0
+    idle_timeout: float = 300.0
+    data_timeout: float = 60.0
+    data_connect_timeout: float = 10.0
+    data_send_buffer: int = 0
+    data_receive_buffer: int = 0
+    log_queue_size: int = 10000
+    log_overflow: str = "drop"
+    metrics_address: str = "127.0.0.1"
+    metrics_port: int = 0
+    listing_cache_size: int = 67108864
+    deflate_level: int = 6
+    digest_cache_entries: int = 4096
+    rate_limit_global: int = 0
+    rate_limit_user: int = 0
+    rate_limit_session: int = 0
+    rate_limit_burst: float = 0.25
+
+
+# keys that must be above 0
+POSITIVE = ("worker_threads", "max_sessions", "listen_backlog", "stor_chunk_size", "log_queue_size")
+# keys where 0 means off, unlimited or the default
+NONNEGATIVE = ("pasv_timeout", "idle_timeout", "data_timeout", "data_connect_timeout", "data_send_buffer",
+               "data_receive_buffer", "listing_cache_size", "digest_cache_entries", "rate_limit_global",
+               "rate_limit_user", "rate_limit_session", "rate_limit_burst")
+# keys that are port numbers, 0 = any free port or disabled
+PORTS = ("pasv_port_min", "pasv_port_max", "metrics_port")
+# keys with a fixed set of values
+CHOICES = {"server_mode": ("threads", "asyncio"), "log_overflow": ("drop", "block")}
+
+
+def parsevalue(fieldtype, value):
+    """
+    Converts a config value to the type of its field
+    :param fieldtype: type of the ServerConfig field
+    :param value: value string from the config file
+    :return: converted value
+    """
+    if fieldtype is bool:
+        if value.upper() not in ("YES", "NO"):
+            raise ValueError("expected YES or NO, got %s" % value)
+        return value.upper() == "YES"
+    return fieldtype(value)
+
+
+def loadconfig(filename="ftpserver.conf"):
+    """
+    Reads <key> = <value> lines from the config file, "#" starts a comment
+    :param filename: config file to parse
+    :return: ServerConfig with defaults for keys that are not set
+    """
+    fieldtypes = {}
+    for field in fields(ServerConfig):
+        fieldtypes[field.name] = field.type
+    values = {}
+    with open(filename, "r") as configfile:
+        for (linenumber, line) in enumerate(configfile, 1):
+            line = line.split("#", 1)[0].strip()
+            if line == "":
+                continue
+            if "=" not in line:
+                raise ValueError("%s line %d: expected <key> = <value>" % (filename, linenumber))
+            (key, value) = line.split("=", 1)
+            key = key.strip()
+            if key not in fieldtypes:
+                print("%s line %d: unknown key %s ignored" % (filename, linenumber, key))
+                continue
+            try:
+                values[key] = parsevalue(fieldtypes[key], value.strip())
+            except ValueError as e:
+                raise ValueError("%s line %d: %s: %s" % (filename, linenumber, key, e))
+    config = ServerConfig(**values)
+    checkconfig(config, filename)
+    return config
+
+
+def checkconfig(config, filename="ftpserver.conf"):
+    """
+    Checks values that parse but cannot work, such as a 0 byte read size or a misspelled mode
+    Raises ValueError naming the first bad key
+    :param config: ServerConfig from loadconfig
+    :param filename: config file name for the message
+    :return: none
+    """
+    for key in POSITIVE:
+        if getattr(config, key) <= 0:
+            raise ValueError("%s: %s must be greater than 0, got %s" % (filename, key, getattr(config, key)))
+    for key in NONNEGATIVE:
+        if getattr(config, key) < 0:
+            raise ValueError("%s: %s must not be negative, got %s" % (filename, key, getattr(config, key)))
+    for key in PORTS:
+        if not 0 <= getattr(config, key) <= 65535:
+            raise ValueError("%s: %s must be a port from 0 to 65535, got %s" % (filename, key, getattr(config, key)))
+    for (key, choices) in CHOICES.items():
+        if getattr(config, key) not in choices:
+            raise ValueError("%s: %s must be %s, got %s" % (filename, key, " or ".join(choices), getattr(config, key)))
+    if config.pasv_port_min > config.pasv_port_max:
+        raise ValueError("%s: pasv_port_min %d is above pasv_port_max %d" % (filename, config.pasv_port_min,
+                                                                              config.pasv_port_max))
+    if not 0 <= config.deflate_level <= 9:
+        raise ValueError("%s: deflate_level must be 0 to 9, got %d" % (filename, config.deflate_level))
+
+
+class ConfigHolder:
+    """
+    Holds the current ServerConfig, sessions take the config that is current when they start
+    SIGHUP swaps in a freshly parsed config without touching running sessions
+    """
+
+    def __init__(self, filename="ftpserver.conf"):
+        """
+        Parse the config file for the first time
+        :param filename: config file to parse
+        """
+        self.filename = filename
+        self.config = loadconfig(filename)
+
+    def reload(self):
+        """
+        Parses the config file again, a broken file keeps the old config
+        :return: none
+        """
+        try:
+            self.config = loadconfig(self.filename)
+            print("Reloaded " + self.filename)
+        except (OSError, ValueError) as e:
+            print("Config reload failed, keeping old config: %s" % e)
+
+    def installsighup(self):
+        """
+        Reload the config file when the process receives SIGHUP
+        :return: none
+        """
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.reload())
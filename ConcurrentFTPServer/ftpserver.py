@@ -11,10 +11,32 @@ import socket
 import sys
 import re
 import os
+import stat
+import posixpath
 import threading
+import queue
+import time
 import os
+import asyncio
+import resource
+import select
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 # import logging
-from logger import Logger
+from logger import Logger, getlogwriter
+from linereader import LineReader
+from authusers import CredentialStore
+from config import ConfigHolder
+from passiveports import PassivePortManager
+from metrics import Metrics, MetricsServer
+from listing import factline, listnames, scandirfacts
+from listcache import ListingCache
+from transfertype import CHUNKSIZE, SENDFILESLICE, CRLFDecoder, CRLFEncoder
+from activemode import ActiveConnector, parseport, parseeprt, samehost
+from compression import compressor, inflate
+from checksums import ALGORITHMS, DigestCache
+from throttle import RateLimiter, Throttle
+from reaper import RECHECK, Reaper, unsentbytes
 
 
 class ServerSocket:
@@ -23,13 +45,17 @@ class ServerSocket:
     Accept a client, listen for requests, close connection
     """
 
-    def __init__(self, logfile, port=2121):
+    def __init__(self, logfile, port=2121, backlog=5, host=""):
         """
         Initialize ServerSocket with logfile and portnumber
         :param logfile: logfile from client
         :param port: opened port server is listening on
+        :param backlog: number of pending connections the kernel queues before refusing
+        :param host: address to listen on, empty for the address of this machine's hostname
         """
         self.port = port
+        if host == "":
+            host = socket.gethostname()
         # Create listening socket
         try:
             self.serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -38,31 +64,142 @@ class ServerSocket:
             print("Socket creation failed with error: " + e)
 
         # Bind socket to port and ip
-        self.serversocket.bind((socket.gethostname(), self.port))
-        self.serversocket.listen(5)
-        print("server listening: ip %s, port %s" % (socket.gethostbyname(socket.gethostname()), self.port))
+        self.serversocket.bind((host, self.port))
+        self.serversocket.listen(backlog)
+        print("server listening: ip %s, port %s" % (socket.gethostbyname(host), self.port))
 
     # Returns client socket and address of client connection
     def accept(self):
-        return self.serversocket.accept()
+        (clientsocket, address) = self.serversocket.accept()
+        # replies are small writes the client waits on, Nagle would hold the second of two
+        # back until the client's delayed ACK of the first
+        clientsocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return (clientsocket, address)
 
     def close(self):
         self.serversocket.close()
 
 
+class SessionPool:
+    """
+    Fixed pool of worker threads serving queued client sessions
+    Each worker holds one session for its whole life, so no more sessions are admitted than there are workers:
+    an admitted client always has a free worker and is greeted at once instead of waiting for another session to end
+    Admission is checked on the accept thread so a full server answers 421 right away
+    """
+
+    def __init__(self, logfile, settings):
+        """
+        Start the worker threads
+        :param logfile: log file passed into each session
+        :param settings: ConfigHolder, worker_threads sessions are served at the same time,
+        max_sessions can only lower that
+        """
+        self.logfile = logfile
+        self.settings = settings
+        self.sessions = queue.Queue()
+        self.admitted = 0
+        # fixed at startup like the pool itself
+        self.workers = settings.config.worker_threads
+        self.lock = threading.Lock()
+        for x in range(self.workers):
+            worker = threading.Thread(target=self.work, daemon=True)
+            worker.start()
+
+    def submit(self, clientsocket, address):
+        """
+        Queues a new client for the next free worker, or rejects it when the server is at capacity
+        :param clientsocket: client socket returned from .accept()
+        :param address: address returned from .accept()
+        :return: True if the client was admitted
+        """
+        with self.lock:
+            if self.admitted >= min(self.settings.config.max_sessions, self.workers):
+                admitted = False
+            else:
+                self.admitted += 1
+                admitted = True
+        if not admitted:
+            FTPServer.metrics.inc("ftp_sessions_rejected_total")
+            rejectclient(clientsocket)
+            return False
+        self.sessions.put((clientsocket, address))
+        return True
+
+    def work(self):
+        """
+        Serves queued sessions one at a time for the life of the server
+        :return: none
+        """
+        while True:
+            (clientsocket, address) = self.sessions.get()
+            ftpserver = None
+            try:
+                ftpserver = FTPServer(clientsocket, address, self.logfile, self.settings.config)
+                ftpserver.runprotocol()
+            except Exception as e:
+                # a broken session must not take its worker down with it
+                print(e)
+            finally:
+                if ftpserver is not None:
+                    ftpserver.close()
+                clientsocket.close()
+                with self.lock:
+                    self.admitted -= 1
+
+
+def rejectclient(clientsocket):
+    """
+    Tells a client the server is full and closes its connection without starting a session
+    :param clientsocket: client socket returned from .accept()
+    :return: none
+    """
+    try:
+        clientsocket.sendall("421 Too many connections\r\n".encode())
+    except socket.error as e:
+        print(e)
+    finally:
+        clientsocket.close()
+
+
 class FTPServer(threading.Thread):
     """
     Concurrent FTP server
     """
 
-    def __init__(self, clientsocket, address, logfile):
+    # directory fd every session path is resolved against, None resolves against the process cwd
+    rootfd = None
+    # authorized users shared by all sessions
+    credentials = CredentialStore("authusers.txt")
+    # passive listeners shared by all sessions
+    passiveports = PassivePortManager()
+    # encoded LIST and MLSD replies shared by all sessions, replaced in main
+    listingcache = ListingCache()
+    # opens and tunes data connections for all sessions, replaced in main
+    activeconnector = ActiveConnector()
+    # file digests shared by all sessions, replaced in main
+    digestcache = DigestCache()
+    # global and per user bandwidth limits, set from the config of each login
+    ratelimiter = RateLimiter()
+    # closes idle sessions and aborts stalled transfers of all sessions, replaced in main
+    reaper = Reaper()
+    # counters and histograms shared by all sessions
+    metrics = Metrics()
+    # verbs counted by name in ftp_commands_total, anything else is counted as OTHER
+    knowncommands = ("USER", "PASS", "SYST", "PWD", "CWD", "CDUP", "PORT", "PASV", "EPSV", "EPRT",
+                     "LIST", "STOR", "RETR", "QUIT", "REST", "SIZE", "APPE", "NOOP", "MLSD", "MLST", "FEAT",
+                     "TYPE", "MODE", "OPTS", "HASH", "XCRC", "XMD5", "XSHA256")
+
+    def __init__(self, clientsocket, address, logfile, config):
         """
         Create FTP server using client socker connection
         :param clientsocket: client socket to connect to
         :param address: address returned from .accept()
         :param logfile: log file passed into Logger object
+        :param config: ServerConfig the session runs with
         """
         self.clientsocket = clientsocket
+        self.reader = LineReader(clientsocket)
         self.address = address
         self.username = ""
         self.password = ""
@@ -72,24 +209,34 @@ class FTPServer(threading.Thread):
         self.passivemode = False
         self.passivemodesocket = None
         self.logger = Logger(logfile)
-        self.portdata = None
+        # (family, host, port) from PORT or EPRT
+        self.activeaddress = None
         self.passivedata = None
+        # offset from REST, applies to the next command only
+        self.restoffset = 0
+        # "A" converts line endings, "I" sends files byte for byte, RFC 959 starts in ASCII
+        self.transfertype = "A"
+        # "S" sends data as is, "Z" deflates everything on the data connection
+        self.transfermode = "S"
         self.loggedin = False
-        self.portconfigmode = False
-        self.pasvconfigmode = False
+        # algorithm used by HASH, chosen with OPTS HASH
+        self.hashalgorithm = "SHA-256"
+        # bandwidth limits of the data connections, set at login
+        self.throttle = Throttle(())
+        # last command or data connection progress, checked by the reaper
+        self.lastactivity = time.monotonic()
+        # set by the reaper when it shuts down a stalled data connection
+        self.datastalled = False
+        # unacknowledged bytes on the data connection after the last send, None when unknown
+        self.dataunsent = None
+        # set by close, the reaper drops the session from then on
+        self.closed = False
+        self.config = config
+        self.metrics.inc("ftp_sessions_total")
+        self.metrics.inc("ftp_sessions_active")
+        # virtual working directory, "/" is the configured root directory
+        self.workingdir = "/"
 
-    def threading(function):
-        """
-        Create thread for multiple clients
-        :param function: function that needs to use threading
-        :return: none
-        """
-        def threadwrapper(self, *args):
-            thread = threading.Thread(target=function, args=(self,))
-            thread.start()
-        return threadwrapper
-
-    @threading
     def runprotocol(self):
         """
         Handles beginning the protocol from the server side by looping until the client closes connection
@@ -97,22 +244,18 @@ class FTPServer(threading.Thread):
         """
         self.logger.serverstarted(self.addressip)
         self.serviceready()
-        # log client connected ip and port
-        newclientrequest = self.receive()
-        self.user(newclientrequest)
-        self.passwd()
-        # get SYST command from client
-        if (self.receive()[:4] == "SYST"):
-            opsys = sys.platform
-            response = "215 System: " + opsys
-            self.send(response)
-        else:
-            pass
-        self.configfilemodes()
+        self.reaper.watch(self)
         while True:
             # If the client quits close the connection
             clientrequest = self.receive()
+            if not clientrequest:
+                # client disconnected, the connection failed or the reaper closed it after idle_timeout
+                break
+            if not clientrequest.split():
+                # blank line
+                continue
             self.parseclientrequest(clientrequest)
+            self.lastactivity = time.monotonic()
             if clientrequest[:4] == "QUIT":
                 print("Client closed connection")
                 break
@@ -124,47 +267,120 @@ class FTPServer(threading.Thread):
         :return: none
         """
         command = (clientrequest.split())[0]
+        verb = command if command in self.knowncommands else "OTHER"
+        self.metrics.inc("ftp_commands_total", labels=(("verb", verb),))
+        # REST only holds for the command right after it
+        offset = self.restoffset
+        self.restoffset = 0
         if command == "QUIT":
             self.quit()
-        if self.loggedin == True:
-            if command == "PWD":
+        elif command == "USER":
+            self.user(clientrequest)
+        elif command == "PASS":
+            self.passwd(clientrequest)
+        elif command == "NOOP":
+            self.noop()
+        elif command == "FEAT":
+            self.feat()
+        elif self.loggedin == True:
+            if command == "SYST":
+                self.syst()
+            elif command == "PWD":
                 self.pwd()
             elif command == "CWD":
-                path = (clientrequest.split())[1]
-                self.cwd(path)
+                path = self.argument(clientrequest)
+                if path is not None:
+                    self.cwd(path)
             elif command == "CDUP":
                 self.cdup()
             elif command == "PORT": #add checking for config file value
-                if (self.portconfigmode == False):
+                if (self.config.port_mode == False):
                     self.send("500 Active mode not configured")
                 else:
-                    # pass in connection data
-                    self.passivemode = False
-                    connectiondata = (clientrequest.split("PORT ", 1))[1]
-                    self.portdata = connectiondata
-                    self.port()
+                    self.port(clientrequest)
             elif command == "PASV": #add checking for config file value
-                if(self.pasvconfigmode == False):
+                if(self.config.pasv_mode == False):
                     # not configured to use passive mode
                     self.send("500 Passive mode not configured")
                 else:
                     self.passivemode = True
                     self.pasv()
             elif command == "LIST":
-                self.list()
+                self.list(self.pathargument(clientrequest))
+            elif command == "MLSD":
+                self.mlsd(self.pathargument(clientrequest))
+            elif command == "MLST":
+                self.mlst(self.pathargument(clientrequest))
             elif command == "STOR":
-                file = (clientrequest.split())[1]
-                self.stor(file)
+                file = self.argument(clientrequest)
+                if file is not None:
+                    self.stor(file, offset)
+            elif command == "APPE":
+                file = self.argument(clientrequest)
+                if file is not None:
+                    self.stor(file, offset, append=True)
             elif command == "RETR":
-                file = (clientrequest.split())[1]
-                self.retr(file)
+                file = self.argument(clientrequest)
+                if file is not None:
+                    self.retr(file, offset)
+            elif command == "REST":
+                self.rest(clientrequest)
+            elif command == "TYPE":
+                self.type(clientrequest)
+            elif command == "MODE":
+                self.mode(clientrequest)
+            elif command == "OPTS":
+                self.opts(clientrequest)
+            elif command == "HASH":
+                self.hash(self.pathargument(clientrequest))
+            elif command == "XCRC":
+                self.xchecksum(self.pathargument(clientrequest), "CRC32")
+            elif command == "XMD5":
+                self.xchecksum(self.pathargument(clientrequest), "MD5")
+            elif command == "XSHA256":
+                self.xchecksum(self.pathargument(clientrequest), "SHA-256")
+            elif command == "SIZE":
+                file = self.argument(clientrequest)
+                if file is not None:
+                    self.size(file)
             elif command == "EPSV":
-                self.epsv()
+                if(self.config.pasv_mode == False):
+                    self.send("500 Passive mode not configured")
+                else:
+                    self.epsv()
             elif command == "EPRT":
-                self.eprt()
+                if (self.config.port_mode == False):
+                    self.send("500 Active mode not configured")
+                else:
+                    self.eprt(clientrequest)
+            else:
+                self.send("502 Command not implemented.")
         else:
             self.send("500 Not authorized. Please login.")
 
+    def argument(self, clientrequest):
+        """
+        Takes the required argument after a command, it may contain spaces
+        :param clientrequest: full request line from client
+        :return: argument, None once 501 has been sent because there is none
+        """
+        parts = clientrequest.strip().split(" ", 1)
+        if len(parts) < 2 or parts[1].strip() == "":
+            self.send("501 Syntax error in parameters or arguments.")
+            return None
+        return parts[1].strip()
+
+    def pathargument(self, clientrequest):
+        """
+        Takes the optional path after a command, paths may contain spaces
+        :param clientrequest: full request line from client
+        :return: path, "." when there is none
+        """
+        parts = clientrequest.strip().split(" ", 1)
+        if len(parts) < 2 or parts[1].strip() == "":
+            return "."
+        return parts[1].strip()
+
     def serviceready(self):
         """
         Send to user that FTP service is ready to use once connecting
@@ -193,55 +409,32 @@ class FTPServer(threading.Thread):
 
     def receive(self):
         """
-        Handles receiving commands from the client socket and logs what was received
-        :return: none
+        Handles receiving one command line from the client socket and logs what was received
+        :return: command line from the client
         """
         try:
-            clientdata = self.clientsocket.recv(4096)
-            self.logger.received(clientdata.decode())
-            return clientdata.decode()
+            clientdata = self.reader.readline()
+            self.lastactivity = time.monotonic()
+            self.logger.received(clientdata)
+            return clientdata
         except socket.error as e:
             print(e)
+        except ValueError as e:
+            # line too long or not UTF-8, the rest of the stream cannot be trusted
+            print(e)
+            try:
+                self.send("500 Command line too long or not valid UTF-8.")
+            except socket.error:
+                pass
 
     def authuser(self, user, password):
         """
-        Checks if user and pass are authorized by reading authusers.txt
+        Checks if user and pass are authorized against the in memory copy of authusers.txt
         :param user: authorized user name
         :param password: authorized password
         :return: True if user and password pair exists in authorized users file
         """
-        authusersfile = open("authusers.txt", "r")
-        # loop through auth users file
-        for line in authusersfile:
-            if user in line:
-                # get password matched to it and check
-                authpassword = (line.split(":"))[1]
-                if password.split() == authpassword.split():
-                    return True
-                else:
-                    return False
-
-    def configfilemodes(self):
-        """
-        reads in config file and parses values
-        to determine which modes should be used
-        and which are not configured
-        :return:
-        """
-        # read in fixed name config file
-        configfile = open("ftpserver.conf", "r")
-        for line in configfile:
-            if "#" not in line:
-                if "port_mode" in line:
-                    # get value of port mode
-                    portvalue = (line.split("=")[1]).strip()
-                    if portvalue == "YES":
-                        self.portconfigmode = True
-                elif "pasv_mode" in line:
-                    # get value of pasv mode
-                    pasvvalue = (line.split("=")[1]).strip()
-                    if pasvvalue == "YES":
-                        self.pasvconfigmode = True
+        return self.credentials.authenticate(user, password)
 
     def user(self, command):
         """
@@ -249,33 +442,116 @@ class FTPServer(threading.Thread):
         :param command: full command from the client socket
         :return:
         """
-        # split user command and get username
-        self.username = (command.split())[1]
+        # a new USER starts a new login, the old one no longer holds
+        self.loggedin = False
+        username = self.argument(command)
+        if username is None:
+            return
+        self.username = username
         self.send("331 Please specify the password.")
 
-    def passwd(self):
+    def passwd(self, usercommand):
         """
         Response to client sending PASS
+        :param usercommand: full command from the client socket
         :return: none
         """
         # Validate username and password
-        usercommand = self.receive()
-        self.password = (usercommand.split())[1]
+        password = self.argument(usercommand)
+        if password is None:
+            return
+        self.password = password
         # check that user pass pair are in auth users file
         if self.authuser(self.username, self.password):
             self.send("230 Login successful.")
             self.loggedin = True
+            self.throttle = self.ratelimiter.throttle(self.username, self.config)
         else:
+            self.loggedin = False
+            self.metrics.inc("ftp_auth_failures_total")
             self.send("530 Login incorrect")
 
+    def noop(self):
+        """
+        Response to client sending NOOP, clients use it to check a pooled connection is still alive
+        :return: none
+        """
+        self.send("200 NOOP ok.")
+
+    def feat(self):
+        """
+        Response to client sending FEAT, lists the extensions clients can use
+        :return: none
+        """
+        hashes = ";".join([name + ("*" if name == self.hashalgorithm else "") for name in ALGORITHMS])
+        self.send("211-Features:\r\n EPRT\r\n EPSV\r\n HASH %s\r\n MLST type*;size*;modify*;unix.mode*;\r\n"
+                  " MODE Z\r\n REST STREAM\r\n SIZE\r\n XCRC\r\n XMD5\r\n XSHA256\r\n211 End" % hashes)
+
+    def syst(self):
+        """
+        Response to client sending SYST
+        :return: none
+        """
+        opsys = sys.platform
+        self.send("215 System: " + opsys)
+
+    def virtualpath(self, path):
+        """
+        Resolves a client path against the session working directory
+        ".." can never climb above the root directory
+        :param path: absolute or relative path from the client
+        :return: normalized absolute virtual path
+        """
+        path = posixpath.normpath(posixpath.join(self.workingdir, path))
+        return "/" + path.lstrip("/")
+
+    def rootpath(self, path):
+        """
+        Turns a client path into a path relative to the root directory, used with dir_fd=self.rootfd
+        so sessions never depend on the process wide working directory
+        :param path: absolute or relative path from the client
+        :return: path relative to the root directory
+        """
+        return self.virtualpath(path).lstrip("/") or "."
+
+    def isdirectory(self, path):
+        """
+        Checks if a client path is an existing directory
+        :param path: absolute or relative path from the client
+        :return: True if path is a directory
+        """
+        try:
+            return stat.S_ISDIR(os.stat(self.rootpath(path), dir_fd=self.rootfd).st_mode)
+        except OSError:
+            return False
+
+    def isfile(self, path):
+        """
+        Checks if a client path is an existing regular file
+        :param path: absolute or relative path from the client
+        :return: True if path is a file
+        """
+        try:
+            return stat.S_ISREG(os.stat(self.rootpath(path), dir_fd=self.rootfd).st_mode)
+        except OSError:
+            return False
+
+    def openpath(self, path, flags):
+        """
+        Opens a client path relative to the root directory
+        :param path: absolute or relative path from the client
+        :param flags: os.open flags
+        :return: file descriptor
+        """
+        return os.open(self.rootpath(path), flags, 0o644, dir_fd=self.rootfd)
+
     def pwd(self):
         """
         Response to client sending PWD
-        print the working directory of the server
+        print the working directory of the session
         :return: none
         """
-        currentdir = os.getcwd()
-        self.send("257 %s is the current directory" % currentdir)
+        self.send("257 %s is the current directory" % self.workingdir)
 
     def cwd(self, path):
         """
@@ -285,8 +561,8 @@ class FTPServer(threading.Thread):
         :return: none
         """
         # Check if path exists
-        if os.path.isdir(path):
-            os.chdir(path)
+        if self.isdirectory(path):
+            self.workingdir = self.virtualpath(path)
             self.send("250 Directory successfully changed.")
         else:
             self.send("550 Failed to change directory.")
@@ -298,34 +574,155 @@ class FTPServer(threading.Thread):
         :return: none
         """
         # 250 Directory successfully changed.
-        os.chdir("..")
+        self.workingdir = self.virtualpath("..")
         self.send("250 Directory successfully changed.")
 
-    def datasocketsend(self, data):
+    def datasocketsend(self, data, command="LIST"):
         """
         Handles responses that need to send data through second data socket connection
-        :param data: data to send through data socket
-        :return: none
+        :param data: encoded bytes, or a list of lines that are sent CRLF terminated
+        :param command: command the transfer is recorded under in the metrics
+        :return: True if all data was sent
         """
-        response = "425 Failed to open data connection"
+        if isinstance(data, bytes):
+            responsedata = data
+        else:
+            responsedata = "".join([x + "\r\n" for x in data]).encode()
+        if self.transfermode == "Z":
+            responsedata = zlib.compress(responsedata, max(0, min(9, self.config.deflate_level)))
+        dsocket = self.opendataconnection()
+        if dsocket is None:
+            self.send("425 Failed to open data connection")
+            return False
+        start = time.monotonic()
         try:
-            # open socket connection
-            dsocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            if self.passivemode:  # use passive socket connection
-                (dsocket, self.address) = self.passivemodesocket.accept()
+            # the whole listing goes out in one call unless it has to be paced
+            self.datasend(dsocket, responsedata)
+            self.metrics.inc("ftp_bytes_sent_total", len(responsedata))
+            self.metrics.observe("ftp_transfer_seconds", time.monotonic() - start, (("command", command),))
+            return True
+        except socket.error as e:
+            print(e)
+            self.send("426 Connection closed; transfer aborted.")
+            return False
+        finally:
+            # close data socket connection
+            self.closedata(dsocket)
 
-            # send data through connection
-            for x in data:
-                responsedata = (x + "\r\n").encode()
-                dsocket.send(responsedata)
+    def pace(self, amount):
+        """
+        Waits until the session's bandwidth limits allow the bytes just sent or received
+        :param amount: bytes
+        :return: none
+        """
+        waited = self.throttle.consume(amount)
+        if waited:
+            self.metrics.inc("ftp_throttle_seconds_total", waited)
 
-            # close data socket connection
-            dsocket.close()
-            if self.passivemode:
-                self.passivemodesocket.close()
+    def writablepoller(self, dsocket):
+        """
+        Switches a data socket to non-blocking sends, so every send returns as soon as the socket buffer is full
+        and progress is recorded per send instead of per slice
+        :param dsocket: connected data socket
+        :return: poll object that waits until the socket takes more bytes or the reaper shuts it down
+        """
+        dsocket.setblocking(False)
+        poller = select.poll()
+        poller.register(dsocket, select.POLLOUT)
+        return poller
 
-        except socket.error as e:
+    def sendprogress(self, dsocket):
+        """
+        Records a send on the data connection for the reaper
+        :param dsocket: connected data socket
+        :return: none
+        """
+        self.lastactivity = time.monotonic()
+        self.dataunsent = unsentbytes(dsocket)
+
+    def datasend(self, dsocket, data):
+        """
+        Sends data on a data connection, at most one slice per send when the session is throttled
+        :param dsocket: connected data socket
+        :param data: bytes to send
+        :return: none
+        """
+        poller = self.writablepoller(dsocket)
+        limit = self.throttle.slice if self.throttle.limited() else len(data)
+        position = 0
+        with memoryview(data) as view:
+            while position < len(view):
+                try:
+                    sent = dsocket.send(view[position:position + limit])
+                except BlockingIOError:
+                    poller.poll()
+                    continue
+                position += sent
+                self.sendprogress(dsocket)
+                self.pace(sent)
+
+    def opendataconnection(self):
+        """
+        Opens the data connection for a transfer, accepting on the passive listener
+        or connecting to the address from PORT
+        :return: connected data socket, None if it could not be opened
+        """
+        dsocket = None
+        try:
+            if self.passivemode:
+                if self.passivemodesocket is None:
+                    return None
+                listener = self.passivemodesocket
+                self.passivemodesocket = None
+                dsocket = self.passiveports.accept(listener, self.addressip)
+                self.activeconnector.tune(dsocket)
+            else:
+                (family, host, port) = self.activeaddress
+                dsocket = self.activeconnector.connect(family, host, port, self.clientsocket.getsockname()[0])
+            # blocking from here on, a stall is caught by the reaper after data_timeout
+            dsocket.settimeout(None)
+            self.datasocket = dsocket
+            self.datastalled = False
+            self.dataunsent = None
+            self.lastactivity = time.monotonic()
+            self.reaper.watch(self)
+            return dsocket
+        except (socket.error, TypeError, ValueError) as e:
+            # no PORT or PASV yet, the client never connected, or it could not be reached
             print(e)
+            if dsocket is not None:
+                dsocket.close()
+            return None
+
+    def closedata(self, dsocket):
+        """
+        Closes the data connection of a finished or failed transfer
+        :param dsocket: socket from opendataconnection
+        :return: none
+        """
+        self.datasocket = None
+        self.lastactivity = time.monotonic()
+        dsocket.close()
+
+    def closepassive(self):
+        """
+        Releases the passive listener if the client never used it
+        :return: none
+        """
+        if self.passivemodesocket is not None:
+            self.passiveports.release(self.passivemodesocket)
+            self.passivemodesocket = None
+
+    def openpassive(self):
+        """
+        Opens a passive listener on the address the client reached the server on
+        :return: port number of the listener, None if no port is free
+        """
+        self.closepassive()
+        self.passivemodesocket = self.passiveports.open(self.clientsocket.getsockname()[0])
+        if self.passivemodesocket is None:
+            return None
+        return self.passivemodesocket.getsockname()[1]
 
     def pasv(self):
         """
@@ -333,16 +730,21 @@ class FTPServer(threading.Thread):
         Uses passive mode for data transfer commands
         :return:
         """
-        # get ip address
-        hostaddress = socket.gethostbyname(socket.gethostname())
-        self.passivemodesocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # get ip address the client reached the server on
+        hostaddress = self.clientsocket.getsockname()[0]
+        if ":" in hostaddress:
+            self.send("425 Use EPSV with IPv6")
+            return
+        port = self.openpassive()
+        if port is None:
+            self.send("425 No passive port available")
+            return
         iparray = hostaddress.split(".")
         h1 = iparray[0]
         h2 = iparray[1]
         h3 = iparray[2]
         h4 = iparray[3]
         # get port number
-        port = self.addressport
         modulo = port % 256
         p1 = int((port - modulo) / 256)
         p2 = modulo
@@ -350,122 +752,433 @@ class FTPServer(threading.Thread):
         self.passivedata = "%s,%s,%s,%s,%s,%s" % (h1, h2, h3, h4, p1, p2)
         self.send("227 Entering Passive Mode. " + connectiondata)
 
-    def port(self):
+    def port(self, clientrequest):
         """
         Response to client sending PORT
         Uses active mode for data transfer commands
+        :param clientrequest: full request line from client
         :return:
         """
-        self.send("200 PORT command successful. Consider using PASV")
+        try:
+            (family, host, port) = parseport(clientrequest.split(" ", 1)[1])
+        except (ValueError, IndexError):
+            self.send("501 Syntax error in parameters or arguments.")
+            return
+        if self.setactive(family, host, port):
+            self.send("200 PORT command successful. Consider using PASV")
+
+    def setactive(self, family, host, port):
+        """
+        Switches the session to active mode once an address from PORT or EPRT is checked
+        Only the client's own address is accepted, so the server cannot be used to connect to third hosts
+        :param family: socket.AF_INET or socket.AF_INET6
+        :param host: client address
+        :param port: client port
+        :return: True if the address was accepted, otherwise the error has been sent
+        """
+        if family != self.clientsocket.family:
+            if self.clientsocket.family == socket.AF_INET6:
+                self.send("522 Network protocol not supported, use (2)")
+            else:
+                self.send("522 Network protocol not supported, use (1)")
+            return False
+        if not samehost(host, self.clientsocket.getpeername()[0]):
+            self.send("500 Illegal PORT command.")
+            return False
+        self.closepassive()
+        self.passivemode = False
+        self.activeaddress = (family, host, port)
+        return True
 
-    def list(self):
+    def list(self, path="."):
         """
         Response to client sending LIST
-        Lists the files and directories in current directory
+        Lists the files and directories in a directory
+        :param path: directory to list, the current directory by default
         :return: none
         """
+        try:
+            dirfd = self.openpath(path, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                dirlist = self.listingcache.get(dirfd, "LIST", listnames)
+            finally:
+                os.close(dirfd)
+        except OSError:
+            self.send("550 Failed to list directory.")
+            return
         self.send("150 Here comes the directory listing.")
-        # open connection with port data
-        if self.passivemode == False:
-            portdata = self.portdata.split(",")
-            host = "%s.%s.%s.%s" % (portdata[0], portdata[1], portdata[2], portdata[3])
-            p1 = int(portdata[4])
-            p2 = int(portdata[5])
-            port = (p1 * 256) + p2
-            dsocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            dsocket.connect((host, port))
-            # send list through dsocket
-            dirlist = os.listdir()
-            for x in dirlist:
-                data = (x + "\r\n").encode()
-                dsocket.send(data)
-
-            dsocket.close()
+        # send list through data connection
+        if self.datasocketsend(dirlist):
             self.send("226 Directory send Ok.")
-        elif self.passivemode:
-            dsocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            (dsocket, self.address) = self.passivemodesocket.accept()
 
-    def stor(self, filename):
+    def mlsd(self, path="."):
+        """
+        Response to client sending MLSD
+        Sends type, size, modify time and mode of every entry in a directory, one fact line per entry
+        :param path: directory to list, the current directory by default
+        :return: none
         """
-        Response to client sending STOR
+        try:
+            dirfd = self.openpath(path, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                facts = self.listingcache.get(dirfd, "MLSD", scandirfacts)
+            finally:
+                os.close(dirfd)
+        except OSError:
+            self.send("550 Failed to list directory.")
+            return
+        self.send("150 Here comes the directory listing.")
+        if self.datasocketsend(facts, "MLSD"):
+            self.send("226 Directory send Ok.")
+
+    def mlst(self, path="."):
+        """
+        Response to client sending MLST
+        Sends the facts of one file or directory on the control connection
+        :param path: file or directory, the current directory by default
+        :return: none
+        """
+        try:
+            filestat = os.stat(self.rootpath(path), dir_fd=self.rootfd)
+        except OSError:
+            self.send("550 Could not get file status.")
+            return
+        virtual = self.virtualpath(path)
+        self.send("250-Listing %s\r\n %s\r\n250 End" % (virtual, factline(filestat, virtual)))
+
+    def type(self, clientrequest):
+        """
+        Response to client sending TYPE
+        TYPE A converts line endings during RETR and STOR, TYPE I (or L 8) transfers bytes unchanged
+        :param clientrequest: full request line from client
+        :return: none
+        """
+        args = clientrequest.upper().split()[1:]
+        if args in (["A"], ["A", "N"]):
+            self.transfertype = "A"
+            self.send("200 Switching to ASCII mode.")
+        elif args in (["I"], ["L", "8"]):
+            self.transfertype = "I"
+            self.send("200 Switching to Binary mode.")
+        else:
+            self.send("504 Command not implemented for that parameter.")
+
+    def mode(self, clientrequest):
+        """
+        Response to client sending MODE
+        MODE Z deflates all data connection traffic, MODE S turns it off
+        :param clientrequest: full request line from client
+        :return: none
+        """
+        args = clientrequest.upper().split()[1:]
+        if args == ["S"]:
+            self.transfermode = "S"
+            self.send("200 Mode set to S.")
+        elif args == ["Z"]:
+            self.transfermode = "Z"
+            self.send("200 Mode set to Z.")
+        else:
+            self.send("504 Command not implemented for that parameter.")
+
+    def opts(self, clientrequest):
+        """
+        Response to client sending OPTS
+        "OPTS HASH <algorithm>" selects the algorithm HASH uses, "OPTS HASH" shows it
+        :param clientrequest: full request line from client
+        :return: none
+        """
+        args = clientrequest.upper().split()[1:]
+        if args[:1] == ["HASH"]:
+            if len(args) == 1:
+                self.send("200 " + self.hashalgorithm)
+            elif args[1] in ALGORITHMS:
+                self.hashalgorithm = args[1]
+                self.send("200 " + self.hashalgorithm)
+            else:
+                self.send("501 Unknown algorithm, current selection not changed")
+        elif args[:1] == ["UTF8"]:
+            self.send("200 Always in UTF8 mode.")
+        else:
+            self.send("501 Option not understood.")
+
+    def checksum(self, path, algorithm):
+        """
+        Digests a file through the shared digest cache
+        :param path: file to digest
+        :param algorithm: key of checksums.ALGORITHMS
+        :return: (lowercase hex digest, file size), None once a 550 has been sent
+        """
+        try:
+            fd = self.openpath(path, os.O_RDONLY)
+        except OSError:
+            self.send("550 No such file.")
+            return None
+        try:
+            filestat = os.fstat(fd)
+            if not stat.S_ISREG(filestat.st_mode):
+                self.send("550 Not a regular file.")
+                return None
+            return (self.digestcache.digest(fd, algorithm), filestat.st_size)
+        except OSError as e:
+            print(e)
+            self.send("550 Could not read file.")
+            return None
+        finally:
+            os.close(fd)
+
+    def hash(self, path):
+        """
+        Response to client sending HASH
+        Replies with the digest of the whole file in the algorithm chosen with OPTS HASH
+        :param path: file to digest
+        :return: none
+        """
+        result = self.checksum(path, self.hashalgorithm)
+        if result is not None:
+            (digest, size) = result
+            self.send("213 %s 0-%d %s %s" % (self.hashalgorithm, max(size - 1, 0), digest, path))
+
+    def xchecksum(self, path, algorithm):
+        """
+        Response to client sending XCRC, XMD5 or XSHA256
+        :param path: file to digest
+        :param algorithm: "CRC32", "MD5" or "SHA-256"
+        :return: none
+        """
+        result = self.checksum(path, algorithm)
+        if result is not None:
+            self.send("250 " + result[0].upper())
+
+    def rest(self, clientrequest):
+        """
+        Response to client sending REST
+        Sets the byte offset the next RETR, STOR or APPE starts at
+        :param clientrequest: full request line from client
+        :return: none
+        """
+        try:
+            offset = int((clientrequest.split())[1])
+        except (IndexError, ValueError):
+            offset = -1
+        if offset < 0:
+            self.send("501 REST requires a byte offset.")
+            return
+        self.restoffset = offset
+        self.send("350 Restarting at %d. Send STORE or RETRIEVE to initiate transfer." % offset)
+
+    def size(self, filename):
+        """
+        Response to client sending SIZE
+        Sends the size of a file, used by clients to find where to resume
+        :param filename: name of file at server
+        :return: none
+        """
+        try:
+            filestat = os.stat(self.rootpath(filename), dir_fd=self.rootfd)
+        except OSError:
+            filestat = None
+        if filestat is None or not stat.S_ISREG(filestat.st_mode):
+            self.send("550 Could not get file size.")
+            return
+        self.send("213 %d" % filestat.st_size)
+
+    def stor(self, filename, offset=0, append=False):
+        """
+        Response to client sending STOR or APPE
         Stores file at the server
         :param filename: name of file to store at server
+        :param offset: byte offset from REST, the file is cut there and the upload written after it
+        :param append: True for APPE, the upload is added to the end of the file
         :return: none
         """
-        if os.path.isfile(filename):
-            self.send("150 Ok to send data.")
-            portdata = self.portdata.split(",")
-            host = "%s.%s.%s.%s" % (portdata[0], portdata[1], portdata[2], portdata[3])
-            p1 = int(portdata[4])
-            p2 = int(portdata[5])
-            port = (p1 * 256) + p2
-            dsocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            dsocket.connect((host, port))
-            filedata = dsocket.recv(4096)
-            file = open(filename, "w+")
-            writedata = filedata.decode()
-            file.write(writedata)
+        if offset:
+            flags = os.O_WRONLY | os.O_CREAT
+        elif append:
+            flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+        else:
+            flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        try:
+            file = open(self.openpath(filename, flags), "wb")
+        except OSError:
+            self.send("553 Could not create file.")
+            return
+        if offset:
+            if offset > os.fstat(file.fileno()).st_size:
+                file.close()
+                self.send("554 Restart offset is past the end of the file.")
+                return
+            # resume: keep the first offset bytes and drop anything after them
+            file.seek(offset)
+            file.truncate()
+        self.send("150 Ok to send data.")
+        dsocket = self.opendataconnection()
+        if dsocket is None:
+            file.close()
+            self.send("425 Failed to open data connection")
+            return
+        # receive into one reusable buffer so memory stays the same for any file size
+        buffer = bytearray(self.config.stor_chunk_size)
+        view = memoryview(buffer)
+        # a throttled upload reads less at a time so the pace stays even
+        readsize = min(len(buffer), self.throttle.slice) if self.throttle.limited() else len(buffer)
+        decoder = CRLFDecoder() if self.transfertype == "A" else None
+        decompressor = zlib.decompressobj() if self.transfermode == "Z" else None
+        start = time.monotonic()
+        total = 0
+        try:
+            with file:
+                while True:
+                    received = dsocket.recv_into(buffer, readsize)
+                    if received == 0:
+                        if self.datastalled:
+                            # the reaper shut the connection down, the upload did not end
+                            raise socket.error("data connection stalled for %s seconds" % self.config.data_timeout)
+                        break
+                    self.lastactivity = time.monotonic()
+                    total += received
+                    self.pace(received)
+                    if decoder is None and decompressor is None:
+                        file.write(view[:received])
+                        continue
+                    pieces = [view[:received]] if decompressor is None else inflate(decompressor, view[:received])
+                    for piece in pieces:
+                        file.write(piece if decoder is None else decoder.decode(bytes(piece)))
+                if decompressor is not None:
+                    if not decompressor.eof:
+                        raise zlib.error("compressed stream ended early")
+                if decoder is not None:
+                    file.write(decoder.flush())
+            self.metrics.observe("ftp_transfer_seconds", time.monotonic() - start, (("command", "STOR"),))
             self.send("226 Transfer complete.")
+        except socket.error as e:
+            print(e)
+            self.send("426 Connection closed; transfer aborted.")
+        except zlib.error as e:
+            print(e)
+            self.send("451 Transfer aborted, bad compressed data.")
+        finally:
+            self.metrics.inc("ftp_bytes_received_total", total)
+            view.release()
+            self.closedata(dsocket)
 
-    def retr(self, file):
+    def retr(self, file, offset=0):
         """
         Response to client sending RETR
         Gets file at the server and stores it at client
         :param file:
+        :param offset: byte offset from REST to start sending at
         :return:
         """
-        if os.path.isfile(file):
+        if self.isfile(file):
             # Send file to the client through data connection
-            self.send("150 Opening BINARY mode data connection")
-            portdata = self.portdata.split(",")
-            host = "%s.%s.%s.%s" % (portdata[0], portdata[1], portdata[2], portdata[3])
-            p1 = int(portdata[4])
-            p2 = int(portdata[5])
-            port = (p1 * 256) + p2
-            dsocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            dsocket.connect((host, port))
-            # send file through socket
-            filedata = open(file, "r")
-            dsocket.send(file.encode())
-            dsocket.close()
-            self.send("226 Transfer complete.")
+            if self.transfertype == "I":
+                self.send("150 Opening BINARY mode data connection")
+            else:
+                self.send("150 Opening ASCII mode data connection")
+            dsocket = self.opendataconnection()
+            if dsocket is None:
+                self.send("425 Failed to open data connection")
+                return
+            start = time.monotonic()
+            try:
+                with open(self.openpath(file, os.O_RDONLY), "rb") as filedata:
+                    if self.transfertype == "I" and self.transfermode == "S":
+                        self.sendfileslices(dsocket, filedata, offset)
+                    else:
+                        self.sendconverted(dsocket, filedata, file, offset)
+                self.metrics.observe("ftp_transfer_seconds", time.monotonic() - start, (("command", "RETR"),))
+                self.send("226 Transfer complete.")
+            except socket.error as e:
+                print(e)
+                self.send("426 Connection closed; transfer aborted.")
+            finally:
+                self.closedata(dsocket)
         else:
             self.send("500 No such file or directory")
 
+    def sendfileslices(self, dsocket, filedata, offset=0):
+        """
+        Sends a file with sendfile, which copies from the page cache to the socket in the kernel
+        Every call returns once the socket buffer is full, so the reaper sees a slow client still making progress,
+        and a throttled session sends at most one slice per call and waits between them
+        :param dsocket: connected data socket
+        :param filedata: file opened in binary mode
+        :param offset: byte offset in the file to start at
+        :return: none
+        """
+        poller = self.writablepoller(dsocket)
+        slicesize = self.throttle.slice if self.throttle.limited() else SENDFILESLICE
+        while True:
+            try:
+                sent = os.sendfile(dsocket.fileno(), filedata.fileno(), offset, slicesize)
+            except BlockingIOError:
+                poller.poll()
+                continue
+            if sent == 0:
+                break
+            offset += sent
+            self.sendprogress(dsocket)
+            self.metrics.inc("ftp_bytes_sent_total", sent)
+            self.pace(sent)
+
+    def sendconverted(self, dsocket, filedata, filename, offset=0):
+        """
+        Sends a file a large chunk at a time, converting LF line endings to CRLF for TYPE A
+        and deflating for MODE Z
+        :param dsocket: connected data socket
+        :param filedata: file opened in binary mode
+        :param filename: name of the file, already compressed files are sent with deflate level 0
+        :param offset: byte offset in the file to start at
+        :return: none
+        """
+        filedata.seek(offset)
+        encoder = CRLFEncoder() if self.transfertype == "A" else None
+        deflate = compressor(filename, self.config.deflate_level) if self.transfermode == "Z" else None
+        while True:
+            chunk = filedata.read(CHUNKSIZE)
+            if not chunk:
+                break
+            if encoder is not None:
+                chunk = encoder.encode(chunk)
+            if deflate is not None:
+                chunk = deflate.compress(chunk)
+            if chunk:
+                self.datasend(dsocket, chunk)
+                self.metrics.inc("ftp_bytes_sent_total", len(chunk))
+        if deflate is not None:
+            chunk = deflate.flush()
+            self.datasend(dsocket, chunk)
+            self.metrics.inc("ftp_bytes_sent_total", len(chunk))
+
     def epsv(self):
         """
         Response to client sending EPSV
         :return: none
         """
-        # get ip address
         self.passivemode = True
         # open data connection before client does
-        self.passivemodesocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.passivemodesocket.bind((self.addressip, 0))
-        self.passivemodesocket.listen(5)
+        port = self.openpassive()
+        if port is None:
+            self.send("425 No passive port available")
+            return
+        self.send("229 Entering Extended Passive Mode (|||%s|)" % port)
 
-        hostaddress = self.addressip
-        iparray = hostaddress.split(".")
-        h1 = iparray[0]
-        h2 = iparray[1]
-        h3 = iparray[2]
-        h4 = iparray[3]
-        # get port number
-        port = self.passivemodesocket.getsockname()[1]
-        modulo = port % 256
-        p1 = int((port - modulo) / 256)
-        p2 = modulo
-        connectiondata = "(%s,%s,%s,%s,%s,%s)" % (h1, h2, h3, h4, p1, p2)
-        self.send("227 Entering Passive Mode. " + connectiondata)  # (h1, h2, h3, h4, p1, p2)
-        # add what header and port to use
-
-    def eprt(self):
+    def eprt(self, clientrequest):
         """
         Response to client sending EPRT
+        Active mode with the address given as |protocol|address|port|, IPv6 included
+        :param clientrequest: full request line from client
         :return:
         """
-        self.send("200 EPRT command successful. Consider using EPSV")
+        try:
+            (family, host, port) = parseeprt(clientrequest.split(" ", 1)[1])
+        except (ValueError, IndexError):
+            self.send("501 Syntax error in parameters or arguments.")
+            return
+        if family is None:
+            family = -1
+        if self.setactive(family, host, port):
+            self.send("200 EPRT command successful. Consider using EPSV")
 
     def quit(self):
         """
@@ -480,10 +1193,271 @@ class FTPServer(threading.Thread):
     # Disconnecting from server
     def close(self):
         """
-        Disconnects client from server
+        Disconnects client from server, releasing anything the session still holds
         :return:
         """
-        print("Close connection")
+        self.closed = True
+        self.reaper.forget(self)
+        self.closepassive()
+        self.metrics.dec("ftp_sessions_active")
+
+    def deadline(self, now):
+        """
+        When the reaper should look at the session next
+        :param now: time.monotonic()
+        :return: time.monotonic() deadline, None if the session never times out
+        """
+        if self.config.idle_timeout <= 0 and self.config.data_timeout <= 0:
+            return None
+        if self.datasocket is not None and not self.datastalled:
+            timeout = self.config.data_timeout
+        else:
+            timeout = self.config.idle_timeout
+        if timeout <= 0:
+            # only the other state can time out, look again later
+            return now + RECHECK
+        return self.lastactivity + timeout
+
+    def expired(self, now):
+        """
+        Checks the session against its timeouts
+        :param now: time.monotonic()
+        :return: "stall" if the data connection made no progress for data_timeout,
+        "idle" if no command came for idle_timeout, None otherwise
+        """
+        dsocket = self.datasocket
+        if dsocket is not None and not self.datastalled:
+            if 0 < self.config.data_timeout < now - self.lastactivity:
+                unsent = unsentbytes(dsocket)
+                if unsent is not None and self.dataunsent is not None and unsent < self.dataunsent:
+                    # the client acknowledged data the kernel had already taken from the last send
+                    self.lastactivity = now
+                    self.dataunsent = unsent
+                    return None
+                return "stall"
+        elif 0 < self.config.idle_timeout < now - self.lastactivity:
+            return "idle"
+        return None
+
+    def reap(self, reason):
+        """
+        Called from the reaper thread, aborts a stalled transfer or disconnects an idle client
+        The session's own thread sees the shut down socket and tears the session down as usual
+        :param reason: "stall" or "idle" from expired
+        :return: none
+        """
+        self.metrics.inc("ftp_timeouts_total", 1, (("reason", reason),))
+        if reason == "stall":
+            self.logger.error("data connection stalled for %s seconds, transfer aborted" % self.config.data_timeout)
+            self.datastalled = True
+            self.lastactivity = time.monotonic()
+            dsocket = self.datasocket
+            if dsocket is not None:
+                try:
+                    dsocket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    # the transfer ended in the meantime
+                    pass
+        else:
+            self.logger.error("idle for %s seconds, connection closed" % self.config.idle_timeout)
+            self.hangup()
+
+    def hangup(self):
+        """
+        Tells the client it timed out and shuts the control connection down, waking the session's thread
+        Never blocks, a client that stopped reading just does not get the reply
+        :return: none
+        """
+        try:
+            self.clientsocket.send("421 Timeout.\r\n".encode(), socket.MSG_DONTWAIT)
+        except OSError:
+            pass
+        try:
+            self.clientsocket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class AsyncFTPServer(FTPServer):
+    """
+    FTP session driven by the asyncio event loop
+    The control connection is read on the loop so idle clients cost no thread,
+    each command is handed to a shared worker pool that runs the FTPServer handlers
+    """
+
+    def __init__(self, reader, writer, loop, executor, logfile, config):
+        """
+        Create FTP session from asyncio streams
+        :param reader: StreamReader of the control connection
+        :param writer: StreamWriter of the control connection
+        :param loop: event loop the streams belong to
+        :param executor: worker pool that runs the command handlers
+        :param logfile: log file passed into Logger object
+        :param config: ServerConfig the session runs with
+        """
+        FTPServer.__init__(self, writer.get_extra_info("socket"), writer.get_extra_info("peername"), logfile, config)
+        self.reader = reader
+        self.writer = writer
+        self.loop = loop
+        self.executor = executor
+
+    async def serve(self):
+        """
+        Handles the protocol for one client by reading commands until the client quits or disconnects
+        :return: none
+        """
+        self.logger.serverstarted(self.addressip)
+        self.serviceready()
+        self.reaper.watch(self)
+        while True:
+            clientdata = await self.reader.readline()
+            if not clientdata:
+                # client disconnected or the reaper closed it after idle_timeout
+                break
+            self.lastactivity = time.monotonic()
+            clientrequest = clientdata.decode()
+            self.logger.received(clientrequest)
+            if not clientrequest.split():
+                continue
+            await self.loop.run_in_executor(self.executor, self.parseclientrequest, clientrequest)
+            self.lastactivity = time.monotonic()
+            await self.writer.drain()
+            if clientrequest[:4] == "QUIT":
+                print("Client closed connection")
+                break
+
+    def send(self, command):
+        """
+        Queues a response on the event loop, safe to call from worker threads
+        :param command: response to send
+        :return: none
+        """
+        command = command + "\r\n"
+        self.loop.call_soon_threadsafe(self.writer.write, command.encode())
+        self.logger.sent(command)
+
+    def quit(self):
+        """
+        Response to client sending QUIT
+        :return: none
+        """
+        self.send("221 Goodbye.")
+        self.loop.call_soon_threadsafe(self.writer.close)
+
+    def hangup(self):
+        """
+        Tells the client it timed out and closes the transport, which ends the session's readline
+        :return: none
+        """
+        self.send("421 Timeout.")
+        self.loop.call_soon_threadsafe(self.writer.close)
+
+
+class AsyncServer:
+    """
+    Accepts clients on the event loop and serves all sessions from one thread,
+    blocking work (file and data connection I/O) runs on a fixed worker pool
+    """
+
+    def __init__(self, serversocket, logfile, settings):
+        """
+        Create asyncio server on an already listening socket
+        :param serversocket: ServerSocket to accept clients on
+        :param logfile: log file passed into each session
+        :param settings: ConfigHolder, worker_threads threads run command handlers
+        and max_sessions sessions are served before new clients get 421
+        """
+        self.serversocket = serversocket
+        self.logfile = logfile
+        self.settings = settings
+        self.sessions = 0
+        self.executor = ThreadPoolExecutor(max_workers=settings.config.worker_threads)
+
+    async def handleclient(self, reader, writer):
+        """
+        Runs one client session on the event loop
+        :param reader: StreamReader of the control connection
+        :param writer: StreamWriter of the control connection
+        :return: none
+        """
+        config = self.settings.config
+        if self.sessions >= config.max_sessions:
+            FTPServer.metrics.inc("ftp_sessions_rejected_total")
+            writer.write("421 Too many connections\r\n".encode())
+            writer.close()
+            return
+        self.sessions += 1
+        # as in ServerSocket.accept, replies must not wait on Nagle
+        writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        session = AsyncFTPServer(reader, writer, asyncio.get_running_loop(), self.executor, self.logfile, config)
+        try:
+            await session.serve()
+        except ConnectionError:
+            # client dropped the connection, nothing left to answer
+            pass
+        except (socket.error, IndexError, ValueError) as e:
+            # ValueError: a line past the StreamReader limit or not UTF-8
+            print(e)
+        finally:
+            self.sessions -= 1
+            session.close()
+            writer.close()
+
+    async def serveforever(self):
+        """
+        Accept clients until the server is stopped
+        :return: none
+        """
+        server = await asyncio.start_server(self.handleclient, sock=self.serversocket.serversocket,
+                                            backlog=self.settings.config.listen_backlog)
+        async with server:
+            await server.serve_forever()
+
+    def run(self):
+        """
+        Raise the open file limit so thousands of control connections fit in one process and start the loop
+        :return: none
+        """
+        softlimit, hardlimit = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hardlimit == resource.RLIM_INFINITY or softlimit < hardlimit:
+            try:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (hardlimit, hardlimit))
+            except (ValueError, OSError) as e:
+                print(e)
+        try:
+            asyncio.run(self.serveforever())
+        finally:
+            self.executor.shutdown(wait=False)
+
+
+def startmetrics(config):
+    """
+    Registers the server metrics and serves them over HTTP if metrics_port is set
+    :param config: ServerConfig
+    :return: none
+    """
+    metrics = FTPServer.metrics
+    metrics.updown("ftp_sessions_active", "Sessions currently connected")
+    metrics.counter("ftp_sessions_total", "Sessions started")
+    metrics.counter("ftp_sessions_rejected_total", "Clients turned away with 421")
+    metrics.counter("ftp_commands_total", "Commands received by verb")
+    metrics.counter("ftp_auth_failures_total", "Failed logins")
+    metrics.counter("ftp_bytes_sent_total", "Bytes sent on data connections")
+    metrics.counter("ftp_bytes_received_total", "Bytes received on data connections")
+    metrics.counter("ftp_timeouts_total", "Idle sessions closed and stalled transfers aborted by the reaper")
+    metrics.counter("ftp_throttle_seconds_total", "Seconds data transfers waited for the bandwidth limits")
+    metrics.histogram("ftp_transfer_seconds", "Data transfer duration by command",
+                      (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300))
+    metrics.gauge("ftp_passive_ports_in_use", "Passive listeners currently open",
+                  lambda: FTPServer.passiveports.inuse())
+    metrics.gauge("ftp_listing_cache_bytes", "Bytes of listings held by the listing cache",
+                  lambda: FTPServer.listingcache.size)
+    metrics.counter("ftp_listing_cache_hits_total", "LIST and MLSD replies served from the listing cache",
+                    lambda: FTPServer.listingcache.hits)
+    metrics.counter("ftp_listing_cache_misses_total", "LIST and MLSD replies that had to read the directory",
+                    lambda: FTPServer.listingcache.misses)
+    if config.metrics_port:
+        MetricsServer(metrics, config.metrics_address, config.metrics_port).start()
 
 
 def main():
@@ -496,35 +1470,45 @@ def main():
         logfile = sys.argv[1]
         # pass logfile into FTPserver
         port = sys.argv[2]
-        serversocket = ServerSocket(logfile, int(port))
-        ftpserver = None
-        #Loop for threading
-        #check config file before starting protocol
-        configfile = open("ftpserver.conf", "r")
-        configport = True
-        configpasv = True
-        for line in configfile:
-            if "#" not in line:
-                if "port_mode" in line:
-                    # get value of port mode
-                    portvalue = (line.split("=")[1]).strip()
-                    if portvalue == "NO":
-                        configport = False
-                elif "pasv_mode" in line:
-                    pasvvalue = (line.split("=")[1]).strip()
-                    if pasvvalue == "NO":
-                        configpasv = False
-
-        if configport is False and configpasv is False:
+        # parse config file once, sessions share the parsed config
+        try:
+            settings = ConfigHolder("ftpserver.conf")
+        except (OSError, ValueError) as e:
+            print("Fatal Error: %s" % e)
+            sys.exit(1)
+        config = settings.config
+        # start the one writer thread all sessions log through
+        getlogwriter(logfile, config.log_queue_size, config.log_overflow)
+        # every session resolves its paths against this directory instead of calling os.chdir
+        FTPServer.rootfd = os.open(config.root_dir, os.O_RDONLY | os.O_DIRECTORY)
+        FTPServer.passiveports = PassivePortManager(config.pasv_port_min, config.pasv_port_max, config.pasv_timeout)
+        FTPServer.listingcache = ListingCache(config.listing_cache_size)
+        FTPServer.digestcache = DigestCache(config.digest_cache_entries)
+        FTPServer.activeconnector = ActiveConnector(config.data_connect_timeout, config.data_send_buffer,
+                                                    config.data_receive_buffer)
+        FTPServer.reaper = Reaper(logfile)
+        FTPServer.reaper.start()
+        startmetrics(config)
+        if config.port_mode is False and config.pasv_mode is False:
             print("Fatal Error: Please configure a data transfer mode")
+        elif config.server_mode == "asyncio":
+            serversocket = ServerSocket(logfile, int(port), config.listen_backlog, config.listen_address)
+            settings.installsighup()
+            try:
+                AsyncServer(serversocket, logfile, settings).run()
+            except KeyboardInterrupt:
+                print("Shutting down server")
+                sys.exit()
         else:
+            serversocket = ServerSocket(logfile, int(port), config.listen_backlog, config.listen_address)
+            settings.installsighup()
+            sessionpool = SessionPool(logfile, settings)
             while True:
                 try:
                 # call accept on server socket to get client socket and address
                     (clientsocket, connaddress) = serversocket.accept()
-                    # Pass in clientsocket to FTP server
-                    ftpserver = FTPServer(clientsocket, connaddress, logfile)
-                    ftpserver.runprotocol()
+                    # Pass in clientsocket to the worker pool
+                    sessionpool.submit(clientsocket, connaddress)
                 except KeyboardInterrupt as error:
                     print("Shutting down server")
                     sys.exit()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+"""
+Author: Andrea Mathew
+Created: 10/06/19
+linereader.py
+Description: Buffered line reader for the FTP control connection
+"""
+
+
+class LineReader:
+    """
+    Splits the control connection byte stream into CRLF terminated lines
+    Bytes after the first line stay buffered, so pipelined commands sent in one
+    segment are returned one at a time and a line split across segments is joined
+    """
+
+    def __init__(self, sock, bufsize=4096, maxline=65536):
+        """
+        Create line reader on a connected socket
+        :param sock: socket to read from
+        :param bufsize: number of bytes asked for on each recv
+        :param maxline: longest line accepted, the same limit asyncio's StreamReader has
+        """
+        self.sock = sock
+        self.bufsize = bufsize
+        self.maxline = maxline
+        self.buffer = bytearray()
+
+    def readline(self):
+        """
+        Returns the next line including its line ending, reading from the socket only when no full line is buffered
+        Raises ValueError when the peer sends more than maxline bytes without a line ending
+        :return: decoded line, or an empty string once the connection is closed
+        """
+        while True:
+            end = self.buffer.find(b"\n")
+            if end >= 0:
+                line = bytes(self.buffer[:end + 1])
+                del self.buffer[:end + 1]
+                return line.decode()
+            data = self.sock.recv(self.bufsize)
+            if not data:
+                # connection closed, hand back whatever partial line is left
+                line = bytes(self.buffer)
+                self.buffer.clear()
+                return line.decode()
+            self.buffer += data
+            if len(self.buffer) > self.maxline and self.buffer.find(b"\n") < 0:
+                self.buffer.clear()
+                raise ValueError("line longer than %d bytes" % self.maxline)
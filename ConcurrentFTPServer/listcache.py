@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+
+"""
+Author: Andrea Mathew
+Created: 10/24/19
+listcache.py
+Description: Process wide cache of encoded directory listings, invalidated through inotify
+"""
+import os
+import struct
+import ctypes
+import ctypes.util
+import threading
+import time
+from collections import OrderedDict
+
+# inotify event bits, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_CLOEXEC = 0o2000000
+WATCHMASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+             IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+EVENTHEADER = struct.Struct("iIII")
+
+
+class Inotify:
+    """
+    Thin ctypes wrapper over the inotify system calls
+    """
+
+    def __init__(self):
+        """
+        Create the inotify instance
+        Raises OSError when inotify is not available
+        """
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    def addwatch(self, dirfd):
+        """
+        Watches an open directory, adding the same directory twice returns the same watch
+        :param dirfd: descriptor of the directory
+        :return: watch descriptor
+        """
+        path = ("/proc/self/fd/%d" % dirfd).encode()
+        wd = self.libc.inotify_add_watch(self.fd, path, WATCHMASK)
+        if wd < 0:
+            # ENOSPC when max_user_watches is used up
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return wd
+
+    def removewatch(self, wd):
+        """
+        :param wd: watch descriptor from addwatch
+        :return: none
+        """
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self):
+        """
+        Blocks until events arrive
+        :return: list of (watch descriptor, mask)
+        """
+        data = os.read(self.fd, 65536)
+        events = []
+        position = 0
+        while position + EVENTHEADER.size <= len(data):
+            (wd, mask, cookie, namelength) = EVENTHEADER.unpack_from(data, position)
+            events.append((wd, mask))
+            position += EVENTHEADER.size + namelength
+        return events
+
+
+class ListingCache:
+    """
+    Encoded listings shared by all sessions, keyed by the directory's (device, inode) and the listing command
+    Every cached directory is watched with inotify and its listings are dropped as soon as anything in it
+    changes. Without inotify, or once no more watches can be added, a LIST is reused while the directory's
+    mtime and ctime are unchanged, and MLSD is not cached because file sizes change without touching them
+    The least recently used listings are dropped once the cache holds more than maxbytes
+    """
+
+    def __init__(self, maxbytes=0):
+        """
+        Create cache
+        :param maxbytes: total size of the cached listings, 0 turns the cache off
+        """
+        self.maxbytes = maxbytes
+        # (device, inode, command) -> (listing, watch descriptor or None, mtime_ns, ctime_ns)
+        self.entries = OrderedDict()
+        self.size = 0
+        # watch descriptor -> keys of the listings it guards
+        self.watched = {}
+        # watch descriptor -> events seen, a listing is only stored if none arrived while it was built
+        self.generation = {}
+        # watch descriptor -> builds in progress, the watch is kept until they finish
+        self.building = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.inotify = None
+        if maxbytes > 0:
+            try:
+                self.inotify = Inotify()
+            except (OSError, AttributeError, TypeError) as e:
+                print("Listing cache falling back to mtime checks: %s" % e)
+            if self.inotify is not None:
+                thread = threading.Thread(target=self.watch, daemon=True)
+                thread.start()
+
+    def get(self, dirfd, command, build):
+        """
+        Returns the cached listing of a directory or builds and stores it
+        :param dirfd: descriptor of the open directory
+        :param command: "LIST" or "MLSD", each is cached separately
+        :param build: function taking dirfd and returning the encoded listing
+        :return: encoded listing
+        """
+        if self.maxbytes <= 0:
+            return build(dirfd)
+        dirstat = os.fstat(dirfd)
+        key = (dirstat.st_dev, dirstat.st_ino, command)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.valid(entry, dirstat):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        (wd, generation) = self.addwatch(dirfd)
+        started = time.time()
+        try:
+            listing = build(dirfd)
+        finally:
+            if wd is not None:
+                with self.lock:
+                    if wd in self.building:
+                        self.building[wd] -= 1
+        if wd is None and (command == "MLSD" or started - dirstat.st_mtime < 1.0):
+            # a directory changed within the last second can change again without a new mtime
+            return listing
+        with self.lock:
+            if wd is not None and (wd not in self.watched or self.generation[wd] != generation):
+                # changed while it was being read
+                self.unwatch(wd)
+                return listing
+            self.store(key, (listing, wd, dirstat.st_mtime_ns, dirstat.st_ctime_ns))
+        return listing
+
+    def valid(self, entry, dirstat):
+        """
+        :param entry: cached (listing, watch descriptor, mtime_ns, ctime_ns)
+        :param dirstat: current fstat of the directory
+        :return: True if the listing can be reused
+        """
+        if entry[1] is not None:
+            # watched entries are removed when the directory changes
+            return True
+        return entry[2] == dirstat.st_mtime_ns and entry[3] == dirstat.st_ctime_ns
+
+    def addwatch(self, dirfd):
+        """
+        Watches a directory for the duration of a build
+        :param dirfd: descriptor of the directory
+        :return: (watch descriptor, events seen so far), (None, None) when the directory is checked by mtime
+        """
+        if self.inotify is None:
+            return (None, None)
+        with self.lock:
+            try:
+                wd = self.inotify.addwatch(dirfd)
+            except OSError:
+                return (None, None)
+            self.watched.setdefault(wd, set())
+            self.generation.setdefault(wd, 0)
+            self.building[wd] = self.building.get(wd, 0) + 1
+            return (wd, self.generation[wd])
+
+    def store(self, key, entry):
+        """
+        Adds a listing and drops the least recently used ones over the size limit, called with the lock held
+        :return: none
+        """
+        old = self.entries.pop(key, None)
+        if old is not None:
+            # another session built the same listing at the same time
+            self.size -= len(old[0])
+        if len(entry[0]) > self.maxbytes:
+            if entry[1] is not None:
+                self.unwatch(entry[1])
+            return
+        self.entries[key] = entry
+        self.size += len(entry[0])
+        if entry[1] is not None:
+            self.watched[entry[1]].add(key)
+        while self.size > self.maxbytes:
+            self.discard(next(iter(self.entries)))
+
+    def discard(self, key):
+        """
+        Removes one listing and its watch once nothing else uses it, called with the lock held
+        :return: none
+        """
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.size -= len(entry[0])
+        if entry[1] is not None and entry[1] in self.watched:
+            self.watched[entry[1]].discard(key)
+            self.unwatch(entry[1])
+
+    def unwatch(self, wd):
+        """
+        Removes a watch once no cached listing or running build depends on it, called with the lock held
+        :param wd: watch descriptor
+        :return: none
+        """
+        if wd in self.watched and not self.watched[wd] and not self.building.get(wd):
+            self.inotify.removewatch(wd)
+            del self.watched[wd]
+            del self.generation[wd]
+            self.building.pop(wd, None)
+
+    def watch(self):
+        """
+        Background thread, drops the listings of every directory an inotify event arrives for
+        :return: none
+        """
+        while True:
+            try:
+                events = self.inotify.read()
+            except OSError as e:
+                print(e)
+                return
+            with self.lock:
+                for (wd, mask) in events:
+                    if mask & IN_Q_OVERFLOW:
+                        # events were lost, nothing cached can be trusted
+                        for watched in list(self.watched):
+                            self.generation[watched] += 1
+                            for key in list(self.watched[watched]):
+                                self.discard(key)
+                        continue
+                    if wd not in self.watched:
+                        continue
+                    self.generation[wd] += 1
+                    for key in list(self.watched[wd]):
+                        self.discard(key)
+                    if mask & IN_IGNORED and wd in self.watched:
+                        # the directory was deleted and the kernel removed the watch
+                        del self.watched[wd]
+                        del self.generation[wd]
+                        self.building.pop(wd, None)
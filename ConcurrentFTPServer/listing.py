@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+"""
+Author: Andrea Mathew
+Created: 10/24/19
+listing.py
+Description: Machine readable MLSD/MLST facts, built from one os.scandir pass over a directory
+"""
+import os
+import stat
+import time
+
+
+def factline(filestat, name, stamps=None):
+    """
+    Formats the facts of one entry as "type=file;size=12;modify=20191024120000;unix.mode=0644; name"
+    :param filestat: os.stat_result of the entry
+    :param name: name sent to the client
+    :param stamps: dict of already formatted modify times by second, shared across one listing
+    :return: fact line without CRLF
+    """
+    mode = filestat.st_mode
+    if stat.S_ISDIR(mode):
+        entrytype = "dir"
+    elif stat.S_ISREG(mode):
+        entrytype = "file"
+    elif stat.S_ISLNK(mode):
+        entrytype = "OS.unix=slink"
+    else:
+        entrytype = "OS.unix=other"
+    second = int(filestat.st_mtime)
+    modify = stamps.get(second) if stamps is not None else None
+    if modify is None:
+        modify = time.strftime("%Y%m%d%H%M%S", time.gmtime(second))
+        if stamps is not None:
+            # files in one directory tend to share modify times
+            stamps[second] = modify
+    return "type=%s;size=%d;modify=%s;unix.mode=%04o; %s" % (entrytype, filestat.st_size, modify,
+                                                               stat.S_IMODE(mode), name)
+
+
+def listnames(dirfd):
+    """
+    Builds the whole LIST reply for a directory in one buffer
+    :param dirfd: descriptor of the directory, left open
+    :return: encoded names, each ending in CRLF
+    """
+    return "".join([name + "\r\n" for name in os.listdir(dirfd)]).encode()
+
+
+def scandirfacts(dirfd):
+    """
+    Builds the whole MLSD reply for a directory in one buffer
+    os.scandir returns names and types in large getdents batches and each entry is stat'ed once
+    :param dirfd: descriptor of the directory, left open
+    :return: encoded fact lines, each ending in CRLF
+    """
+    lines = []
+    stamps = {}
+    with os.scandir(dirfd) as entries:
+        for entry in entries:
+            try:
+                filestat = entry.stat()
+            except OSError:
+                try:
+                    # dangling symlink
+                    filestat = entry.stat(follow_symlinks=False)
+                except OSError:
+                    # removed since the directory was read
+                    continue
+            lines.append(factline(filestat, entry.name, stamps))
+            lines.append("\r\n")
+    return "".join(lines).encode()
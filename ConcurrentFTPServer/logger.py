@@ -2,40 +2,150 @@
 
 import sys
 import os
+import time
+import queue
+import atexit
+import threading
 from datetime import datetime
 
 """
 Author: Andrea Mathew
 Created: 10/06/19
 logger.py
-Description: Logger class to handle logging for ftp client
+Description: Logger class to handle logging for ftp server
 """
 
 
+class LogWriter:
+    """
+    Owns the one file handle for a log file and writes queued lines from a background thread
+    Sessions only enqueue, lines are formatted and written in batches so logging never waits on disk
+    """
+
+    def __init__(self, filename, queuesize=10000, overflow="drop", batchsize=512, flushinterval=0.5):
+        """
+        Open the log file and start the writer thread
+        :param filename: log file to append to
+        :param queuesize: number of lines buffered before the overflow policy applies
+        :param overflow: "drop" discards lines when the queue is full, "block" waits for room
+        :param batchsize: most lines written per flush
+        :param flushinterval: seconds between flushes when lines trickle in
+        """
+        self.file = open(filename, "a+")
+        self.queue = queue.Queue(queuesize)
+        self.overflow = overflow
+        self.batchsize = batchsize
+        self.flushinterval = flushinterval
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def write(self, timestamp, message):
+        """
+        Queues a line for the writer thread
+        :param timestamp: time.time() when the event happened
+        :param message: text following the timestamp
+        :return: none
+        """
+        if self.overflow == "block":
+            self.queue.put((timestamp, message))
+            return
+        try:
+            self.queue.put_nowait((timestamp, message))
+        except queue.Full:
+            # counted here, reported by the writer thread once there is room
+            self.dropped += 1
+
+    def run(self):
+        """
+        Writer thread, drains the queue in batches and flushes once per batch
+        :return: none
+        """
+        running = True
+        while running:
+            try:
+                batch = [self.queue.get(timeout=self.flushinterval)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batchsize:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            for item in batch:
+                if item is None:
+                    running = False
+                    break
+                (timestamp, message) = item
+                lines.append("\n" + str(datetime.fromtimestamp(timestamp)) + message)
+            if self.dropped:
+                (dropped, self.dropped) = (self.dropped, 0)
+                lines.append("\n" + str(datetime.now()) + " ERROR log queue full, dropped %d lines" % dropped)
+            self.file.write("".join(lines))
+            self.file.flush()
+
+    def close(self):
+        """
+        Writes out everything still queued and stops the writer thread
+        :return: none
+        """
+        if self.thread.is_alive():
+            try:
+                self.queue.put(None, timeout=self.flushinterval)
+            except queue.Full:
+                pass
+            self.thread.join(self.flushinterval * 4)
+
+
+# one LogWriter per log file, shared by every Logger in the process
+logwriters = {}
+logwriterslock = threading.Lock()
+
+
+def getlogwriter(filename, queuesize=10000, overflow="drop"):
+    """
+    Returns the LogWriter for a log file, starting it on first use
+    :param filename: log file to append to
+    :param queuesize: queue size used if the writer is started by this call
+    :param overflow: overflow policy used if the writer is started by this call
+    :return: LogWriter
+    """
+    with logwriterslock:
+        if filename not in logwriters:
+            logwriters[filename] = LogWriter(filename, queuesize, overflow)
+        return logwriters[filename]
+
+
 class Logger:
     def __init__(self, filename="logs.txt"):
-        self.file = open(filename, "a+")
+        self.writer = getlogwriter(filename)
+
+    def write(self, message):
+        # Hands the line to the shared writer, timestamp is formatted on the writer thread
+        self.writer.write(time.time(), message)
 
     def received(self, message):
         # Logs received messages from server
-        self.file.write("\n" + str(self.time()) + " Received:  " + message[:-1])
+        self.write(" Received:  " + message[:-1])
 
     def connecting(self, hostname):
         # Logs that the client is connecting to specified host
-        self.file.write("\n" + str(self.time()) + " Connecting to " + hostname)
+        self.write(" Connecting to " + hostname)
 
     def sent(self, message):
         # Logs message sent to the server
         message.replace("\r\n", "")
-        self.file.write("\n" + str(self.time()) + " Sent: " + message[:-1])
+        self.write(" Sent: " + message[:-1])
 
     def error(self, message):
         # Logs an error message
-        self.file.write("\n" + str(self.time()) + " ERROR " + message)
+        self.write(" ERROR " + message)
 
     def quit(self):
         # Logs the user quitting the ftp prompt
-        self.file.write("\n" + str(self.time()) + " Client quit, connection closed")
+        self.write(" Client quit, connection closed")
 
     def time(self):
         timestamp = datetime.now()
@@ -43,5 +153,4 @@ class Logger:
 
     # Added logging for server
     def serverstarted(self, hostname):
-        self.file.write("\n" + str(self.time()) + " Server listening at " + hostname)
-
+        self.write(" Server listening at " + hostname)
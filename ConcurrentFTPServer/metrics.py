@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+"""
+Author: Andrea Mathew
+Created: 10/24/19
+metrics.py
+Description: Counters and histograms for the FTP server, served as Prometheus text over HTTP
+"""
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MetricShard:
+    """
+    Values recorded by one thread, only that thread writes to it so no lock is needed
+    """
+
+    def __init__(self):
+        # (name, labels) -> value
+        self.counters = {}
+        # (name, labels) -> [bucket counts, sum, count]
+        self.histograms = {}
+
+
+class Metrics:
+    """
+    Registry of metrics, every thread records into its own shard and a scrape adds the shards up
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.shards = []
+        self.lock = threading.Lock()
+        # name -> (type, help text)
+        self.descriptions = {}
+        # histogram name -> bucket upper bounds
+        self.buckets = {}
+        # gauge or counter name -> function returning the current value
+        self.functions = {}
+
+    def counter(self, name, helptext, function=None):
+        """
+        Registers a counter, a counter that also goes down is reported as a gauge
+        :param name: metric name
+        :param helptext: description shown in the scrape
+        :param function: returns the current total when the count is kept elsewhere, None to count with inc
+        :return: none
+        """
+        self.descriptions[name] = ("counter", helptext)
+        if function is not None:
+            self.functions[name] = function
+
+    def updown(self, name, helptext):
+        """
+        Registers a value that is changed with inc and dec, such as active sessions
+        :param name: metric name
+        :param helptext: description shown in the scrape
+        :return: none
+        """
+        self.descriptions[name] = ("gauge", helptext)
+
+    def gauge(self, name, helptext, function):
+        """
+        Registers a gauge that is read when scraped
+        :param name: metric name
+        :param helptext: description shown in the scrape
+        :param function: returns the current value
+        :return: none
+        """
+        self.descriptions[name] = ("gauge", helptext)
+        self.functions[name] = function
+
+    def histogram(self, name, helptext, buckets):
+        """
+        Registers a histogram
+        :param name: metric name
+        :param helptext: description shown in the scrape
+        :param buckets: sorted bucket upper bounds
+        :return: none
+        """
+        self.descriptions[name] = ("histogram", helptext)
+        self.buckets[name] = list(buckets)
+
+    def shard(self):
+        """
+        :return: the calling thread's shard, created on first use
+        """
+        shard = getattr(self.local, "shard", None)
+        if shard is None:
+            shard = MetricShard()
+            self.local.shard = shard
+            with self.lock:
+                self.shards.append(shard)
+        return shard
+
+    def inc(self, name, amount=1, labels=()):
+        """
+        Adds to a counter
+        :param name: metric name
+        :param amount: value to add
+        :param labels: tuple of (label, value) pairs
+        :return: none
+        """
+        counters = self.shard().counters
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + amount
+
+    def dec(self, name, amount=1, labels=()):
+        """
+        Subtracts from a value registered with updown
+        :return: none
+        """
+        self.inc(name, -amount, labels)
+
+    def observe(self, name, value, labels=()):
+        """
+        Records one value in a histogram
+        :param name: metric name
+        :param value: observed value
+        :param labels: tuple of (label, value) pairs
+        :return: none
+        """
+        histograms = self.shard().histograms
+        key = (name, labels)
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = [[0] * (len(self.buckets[name]) + 1), 0.0, 0]
+            histograms[key] = histogram
+        histogram[0][bisect.bisect_left(self.buckets[name], value)] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+    def collect(self):
+        """
+        Adds up all shards
+        :return: (counters, histograms) dicts keyed by (name, labels)
+        """
+        with self.lock:
+            shards = list(self.shards)
+        counters = {}
+        histograms = {}
+        for shard in shards:
+            for (key, value) in list(shard.counters.items()):
+                counters[key] = counters.get(key, 0) + value
+            for (key, (counts, total, count)) in list(shard.histograms.items()):
+                merged = histograms.setdefault(key, [[0] * len(counts), 0.0, 0])
+                for (index, bucketcount) in enumerate(list(counts)):
+                    merged[0][index] += bucketcount
+                merged[1] += total
+                merged[2] += count
+        return (counters, histograms)
+
+    def render(self):
+        """
+        Formats every metric in the Prometheus text exposition format
+        :return: scrape text
+        """
+        (counters, histograms) = self.collect()
+        lines = []
+        for name in sorted(self.descriptions):
+            (metrictype, helptext) = self.descriptions[name]
+            lines.append("# HELP %s %s" % (name, helptext))
+            lines.append("# TYPE %s %s" % (name, metrictype))
+            if name in self.functions:
+                lines.append("%s %s" % (name, self.functions[name]()))
+            elif metrictype == "histogram":
+                for ((metricname, labels), (counts, total, count)) in sorted(histograms.items()):
+                    if metricname != name:
+                        continue
+                    cumulative = 0
+                    for (bound, bucketcount) in zip(self.buckets[name] + ["+Inf"], counts):
+                        cumulative += bucketcount
+                        lines.append("%s_bucket%s %d" % (name, formatlabels(labels + (("le", str(bound)),)), cumulative))
+                    lines.append("%s_sum%s %s" % (name, formatlabels(labels), total))
+                    lines.append("%s_count%s %d" % (name, formatlabels(labels), count))
+            else:
+                found = False
+                for ((metricname, labels), value) in sorted(counters.items()):
+                    if metricname == name:
+                        lines.append("%s%s %s" % (name, formatlabels(labels), value))
+                        found = True
+                if not found:
+                    lines.append("%s 0" % name)
+        return "\n".join(lines) + "\n"
+
+
+def formatlabels(labels):
+    """
+    :param labels: tuple of (label, value) pairs
+    :return: {label="value",...} or an empty string
+    """
+    if not labels:
+        return ""
+    return "{" + ",".join('%s="%s"' % (label, value) for (label, value) in labels) + "}"
+
+
+class MetricsServer:
+    """
+    Serves GET /metrics from a daemon thread
+    """
+
+    def __init__(self, metrics, host="127.0.0.1", port=9121):
+        """
+        Bind the HTTP server
+        :param metrics: Metrics to render
+        :param host: address to listen on
+        :param port: port to listen on
+        """
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split("?")[0] != "/metrics":
+                    handler.send_error(404)
+                    return
+                body = metrics.render().encode()
+                handler.send_response(200)
+                handler.send_header("Content-Type", "text/plain; version=0.0.4")
+                handler.send_header("Content-Length", str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                # scrapes are not worth a line in the console
+                pass
+
+        self.httpserver = ThreadingHTTPServer((host, port), MetricsHandler)
+        self.httpserver.daemon_threads = True
+
+    def start(self):
+        """
+        Start serving in the background
+        :return: none
+        """
+        thread = threading.Thread(target=self.httpserver.serve_forever, daemon=True)
+        thread.start()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+"""
+Author: Andrea Mathew
+Created: 10/24/19
+passiveports.py
+Description: Hands out passive mode listening sockets from a configured port range
+"""
+import socket
+import time
+import threading
+from collections import deque
+from activemode import samehost
+
+
+class PassivePortManager:
+    """
+    Allocates passive listeners for all sessions
+    Freed ports go to the front of the free list so they are reused first, and
+    listeners no client connected to within the timeout are closed and their ports freed
+    """
+
+    def __init__(self, portmin=0, portmax=0, timeout=30.0):
+        """
+        Create port manager
+        :param portmin: lowest port to hand out, 0 lets the kernel pick any free port
+        :param portmax: highest port to hand out
+        :param timeout: seconds a listener waits for its client before it is closed
+        """
+        self.timeout = timeout
+        if portmin > 0 and portmax >= portmin:
+            self.freeports = deque(range(portmin, portmax + 1))
+        else:
+            self.freeports = None
+        # listener -> deadline for the client to connect, claimed listeners are removed
+        self.listeners = {}
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def inuse(self):
+        """
+        :return: number of passive listeners currently open
+        """
+        return self.opened
+
+    def open(self, host):
+        """
+        Opens a listener on the next free port
+        :param host: local address of the control connection, the client connects back to it
+        :return: listening socket, None if every port in the range is taken
+        """
+        family = socket.AF_INET6 if ":" in host else socket.AF_INET
+        with self.lock:
+            self.expire()
+            if self.freeports is None:
+                listener = self.bind(family, host, 0)
+            else:
+                listener = None
+                for x in range(len(self.freeports)):
+                    port = self.freeports.popleft()
+                    listener = self.bind(family, host, port)
+                    if listener is not None:
+                        break
+                    # held by something outside the server, try it again last
+                    self.freeports.append(port)
+            if listener is not None:
+                self.listeners[listener] = time.monotonic() + self.timeout
+                self.opened += 1
+            return listener
+
+    def bind(self, family, host, port):
+        """
+        Creates a listener bound to one port
+        :param family: socket address family
+        :param host: local address to bind
+        :param port: port to bind, 0 for any
+        :return: listening socket, None if the port is taken
+        """
+        listener = socket.socket(family, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            listener.bind((host, port))
+            listener.listen(1)
+        except socket.error:
+            listener.close()
+            return None
+        listener.settimeout(self.timeout or None)
+        return listener
+
+    def accept(self, listener, peer=None):
+        """
+        Waits up to the timeout for the client to connect, the listener is released either way
+        Connections from any other host are closed and the wait goes on, as PORT refuses other hosts
+        :param listener: socket returned from open
+        :param peer: address of the session's control connection, None accepts any host
+        :return: data socket connected to the client
+        """
+        with self.lock:
+            # claimed listeners are left alone by expire while accept waits on them
+            if self.listeners.pop(listener, None) is None:
+                raise socket.error("passive listener expired")
+        deadline = time.monotonic() + self.timeout
+        try:
+            while True:
+                (dsocket, address) = listener.accept()
+                if peer is None or samehost(address[0], peer):
+                    return dsocket
+                print("Refused data connection from %s, control connection is from %s" % (address[0], peer))
+                dsocket.close()
+                if self.timeout:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise socket.timeout("no data connection from %s" % peer)
+                    listener.settimeout(remaining)
+        finally:
+            with self.lock:
+                self.free(listener)
+
+    def release(self, listener):
+        """
+        Closes a listener that was never accepted on and puts its port at the front of the free list
+        :param listener: socket returned from open
+        :return: none
+        """
+        with self.lock:
+            if self.listeners.pop(listener, None) is not None:
+                self.free(listener)
+
+    def free(self, listener):
+        """
+        Closes a listener and frees its port, caller holds the lock
+        :param listener: socket returned from open
+        :return: none
+        """
+        port = listener.getsockname()[1]
+        listener.close()
+        self.opened -= 1
+        if self.freeports is not None:
+            self.freeports.appendleft(port)
+
+    def expire(self):
+        """
+        Closes listeners whose client never connected, caller holds the lock
+        :return: none
+        """
+        if not self.timeout:
+            return
+        now = time.monotonic()
+        for (listener, deadline) in list(self.listeners.items()):
+            if deadline < now:
+                del self.listeners[listener]
+                self.free(listener)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+"""
+Author: Andrea Mathew
+Created: 10/24/19
+reaper.py
+Description: One timer wheel thread that disconnects idle sessions and aborts stalled transfers for the whole server
+"""
+import math
+import time
+import fcntl
+import struct
+import termios
+import threading
+from logger import Logger
+
+# seconds checked again later when a session's current state has no timeout
+RECHECK = 30.0
+
+
+def unsentbytes(sock):
+    """
+    Bytes a socket holds that the peer has not acknowledged yet (SIOCOUTQ)
+    A slow client is still making progress while this goes down, even if the sender has not been woken
+    because the kernel took megabytes at once into an autotuned send buffer
+    :param sock: connected socket
+    :return: byte count, None where it cannot be read
+    """
+    try:
+        return struct.unpack("i", fcntl.ioctl(sock.fileno(), termios.TIOCOUTQ, b"\0\0\0\0"))[0]
+    except (OSError, AttributeError, ValueError):
+        return None
+
+
+class TimerWheel:
+    """
+    Hashed timing wheel, each deadline is rounded up to a whole tick and kept in the slot of that tick
+    Scheduling and removing cost the same for any number of entries and each tick looks at one slot only
+    Deadlines more than one turn of the wheel away stay in their slot until the turn they are due in
+    """
+
+    def __init__(self, tick=1.0, slots=512):
+        """
+        Create wheel
+        :param tick: seconds per slot
+        :param slots: number of slots, one turn of the wheel is tick * slots seconds
+        """
+        self.tick = tick
+        self.slots = [{} for x in range(slots)]
+        # item -> tick number it is due at
+        self.due = {}
+        self.current = int(time.monotonic() / tick)
+        self.lock = threading.Lock()
+
+    def schedule(self, item, deadline):
+        """
+        Adds an item or moves it to a new deadline
+        :param item: hashable object handed back by advance
+        :param deadline: time.monotonic() the item is due at
+        :return: none
+        """
+        with self.lock:
+            ticknumber = max(int(math.ceil(deadline / self.tick)), self.current + 1)
+            self.removelocked(item)
+            self.due[item] = ticknumber
+            self.slots[ticknumber % len(self.slots)][item] = ticknumber
+
+    def remove(self, item):
+        """
+        :param item: item passed to schedule, nothing happens if it is not in the wheel
+        :return: none
+        """
+        with self.lock:
+            self.removelocked(item)
+
+    def removelocked(self, item):
+        """
+        Removes an item, called with the lock held
+        :return: none
+        """
+        ticknumber = self.due.pop(item, None)
+        if ticknumber is not None:
+            del self.slots[ticknumber % len(self.slots)][item]
+
+    def advance(self, now):
+        """
+        Moves the wheel up to the current time
+        :param now: time.monotonic()
+        :return: list of items whose deadline has passed, they are no longer in the wheel
+        """
+        expired = []
+        with self.lock:
+            target = int(now / self.tick)
+            # after a long pause every slot has been passed at least once
+            steps = min(target - self.current, len(self.slots))
+            for step in range(steps):
+                slot = self.slots[(target - steps + 1 + step) % len(self.slots)]
+                for (item, ticknumber) in list(slot.items()):
+                    if ticknumber <= target:
+                        del slot[item]
+                        del self.due[item]
+                        expired.append(item)
+            self.current = max(self.current, target)
+        return expired
+
+
+class Reaper:
+    """
+    Checks every session against its idle and data stall timeouts from one thread
+    Sessions only record when they were last active, a session is looked at when its deadline comes up and
+    is either reaped or put back in the wheel at its new deadline, so busy sessions cost nothing per command
+    Sessions provide deadline(now) and expired(now), reap(reason) to close them and a "closed" flag set once they end
+    """
+
+    def __init__(self, logfile="logs.txt", tick=1.0):
+        """
+        Create reaper, sessions can be watched before start but nothing is reaped until then
+        :param logfile: log file the number of reaped sessions is written to
+        :param tick: seconds between checks
+        """
+        self.logfile = logfile
+        self.wheel = TimerWheel(tick)
+        self.logger = None
+
+    def start(self):
+        """
+        Starts the reaper thread
+        :return: none
+        """
+        self.logger = Logger(self.logfile)
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+
+    def watch(self, session):
+        """
+        Puts a session in the wheel at its current deadline, call again when it starts a transfer
+        :param session: FTPServer
+        :return: none
+        """
+        deadline = None if session.closed else session.deadline(time.monotonic())
+        if deadline is None:
+            self.wheel.remove(session)
+        else:
+            self.wheel.schedule(session, deadline)
+
+    def forget(self, session):
+        """
+        :param session: FTPServer that has ended
+        :return: none
+        """
+        self.wheel.remove(session)
+
+    def run(self):
+        """
+        Reaper thread, reaps the sessions that are due and logs how many were reaped each tick
+        :return: none
+        """
+        while True:
+            time.sleep(self.wheel.tick)
+            now = time.monotonic()
+            reaped = {}
+            for session in self.wheel.advance(now):
+                if session.closed:
+                    # ended after it was taken off the wheel or while being put back
+                    continue
+                reason = session.expired(now)
+                if reason is None:
+                    # active since it was scheduled
+                    self.watch(session)
+                    continue
+                try:
+                    session.reap(reason)
+                except Exception as e:
+                    # one broken session must not stop the reaper
+                    print(e)
+                reaped[reason] = reaped.get(reason, 0) + 1
+                if reason != "idle":
+                    # the session itself is still open and goes back to waiting for commands
+                    self.watch(session)
+            if reaped:
+                self.logger.write(" Reaper: closed %d idle sessions, aborted %d stalled transfers"
+                                  % (reaped.get("idle", 0), reaped.get("stall", 0)))
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+"""
+Author: Andrea Mathew
+Created: 10/24/19
+throttle.py
+Description: Token buckets that limit data connection bandwidth for the whole server, each user and each session
+"""
+import time
+import threading
+
+# most bytes sent or received per step of a throttled transfer
+MAXSLICE = 262144
+# fewest bytes per step, so a low limit still moves data in useful pieces
+MINSLICE = 16384
+
+
+class TokenBucket:
+    """
+    Holds up to "rate * burst" bytes of tokens, refilled from the time passed since it was last used
+    so a bucket costs nothing while idle and never needs a timer
+    A transfer may take more tokens than there are and then waits until the debt is refilled
+    """
+
+    def __init__(self, rate, burst):
+        """
+        Create bucket, full
+        :param rate: bytes per second, 0 = unlimited
+        :param burst: seconds of traffic the bucket can save up
+        """
+        self.rate = 0
+        self.capacity = 0.0
+        self.tokens = 0.0
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+        self.setrate(rate, burst)
+
+    def setrate(self, rate, burst):
+        """
+        Changes the limit, tokens already saved up are kept up to the new capacity
+        :param rate: bytes per second, 0 = unlimited
+        :param burst: seconds of traffic the bucket can save up
+        :return: none
+        """
+        with self.lock:
+            if rate == self.rate and rate * burst == self.capacity:
+                return
+            self.capacity = float(rate * burst)
+            self.tokens = self.capacity if self.rate == 0 else min(self.tokens, self.capacity)
+            self.rate = rate
+            self.stamp = time.monotonic()
+
+    def take(self, amount, now):
+        """
+        Takes tokens, going into debt if there are not enough
+        :param amount: bytes about to be sent or just received
+        :param now: time.monotonic()
+        :return: seconds until the bucket is out of debt, 0 if there were enough tokens
+        """
+        with self.lock:
+            if self.rate <= 0:
+                return 0.0
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+
+class Throttle:
+    """
+    Limits one session's data connections through its own bucket and the shared user and global buckets
+    Every step takes its bytes from all of them at once and sleeps for the slowest, so whichever limit
+    is tightest decides the pace
+    """
+
+    def __init__(self, buckets):
+        """
+        Create throttle
+        :param buckets: TokenBucket objects that apply, empty for an unlimited session
+        """
+        self.buckets = [bucket for bucket in buckets if bucket.rate > 0]
+        # step size fitted to the lowest rate, about 20 steps a second at that rate
+        self.slice = MAXSLICE
+        if self.buckets:
+            lowest = min(bucket.rate for bucket in self.buckets)
+            self.slice = int(max(MINSLICE, min(MAXSLICE, lowest // 20)))
+
+    def limited(self):
+        """
+        :return: True if any limit applies to the session
+        """
+        return len(self.buckets) > 0
+
+    def consume(self, amount):
+        """
+        Takes tokens for data sent or received and sleeps until every bucket allows more
+        :param amount: bytes
+        :return: seconds slept
+        """
+        if not self.buckets or amount <= 0:
+            return 0.0
+        now = time.monotonic()
+        wait = 0.0
+        for bucket in self.buckets:
+            wait = max(wait, bucket.take(amount, now))
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class RateLimiter:
+    """
+    The global bucket and one bucket per user, shared by all sessions
+    """
+
+    def __init__(self):
+        """
+        Create limiter, unlimited until the first session applies its config
+        """
+        self.globalbucket = TokenBucket(0, 0)
+        # user name -> TokenBucket
+        self.users = {}
+        self.lock = threading.Lock()
+
+    def throttle(self, username, config):
+        """
+        Builds the throttle of a session that just logged in
+        The session's config sets the global and user limits too, so after SIGHUP they change with the next login
+        :param username: user the session logged in as
+        :param config: ServerConfig of the session
+        :return: Throttle
+        """
+        burst = config.rate_limit_burst
+        self.globalbucket.setrate(config.rate_limit_global, burst)
+        with self.lock:
+            userbucket = self.users.get(username)
+            if userbucket is None:
+                userbucket = TokenBucket(config.rate_limit_user, burst)
+                self.users[username] = userbucket
+        userbucket.setrate(config.rate_limit_user, burst)
+        return Throttle((self.globalbucket, userbucket, TokenBucket(config.rate_limit_session, burst)))
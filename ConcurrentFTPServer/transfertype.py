@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+"""
+Author: Andrea Mathew
+Created: 10/24/19
+transfertype.py
+Description: Line ending conversion for TYPE A transfers, done on whole chunks instead of line by line
+"""
+
+# bytes read from the file per ASCII mode send
+CHUNKSIZE = 262144
+# most bytes per sendfile call in TYPE I, a call returns earlier once the socket buffer is full
+SENDFILESLICE = 1048576
+
+
+class CRLFEncoder:
+    """
+    Converts LF line endings to the CRLF sent on the wire
+    Lines that already end in CRLF are sent unchanged, also when the CR and LF fall in different chunks
+    """
+
+    def __init__(self):
+        self.lastcr = False
+
+    def encode(self, chunk):
+        """
+        :param chunk: bytes read from the file
+        :return: bytes to send
+        """
+        if not chunk:
+            return chunk
+        converted = chunk.replace(b"\r\n", b"\n").replace(b"\n", b"\r\n")
+        if self.lastcr and chunk[:1] == b"\n":
+            # the CR went out at the end of the last chunk
+            converted = converted[1:]
+        self.lastcr = chunk[-1:] == b"\r"
+        return converted
+
+
+class CRLFDecoder:
+    """
+    Converts CRLF received on the wire back to LF
+    A CR at the end of a chunk is held back until the next chunk shows whether an LF follows it
+    """
+
+    def __init__(self):
+        self.pending = False
+
+    def decode(self, chunk):
+        """
+        :param chunk: bytes received from the data connection
+        :return: bytes to write to the file
+        """
+        if self.pending:
+            chunk = b"\r" + chunk
+            self.pending = False
+        if chunk.endswith(b"\r"):
+            chunk = chunk[:-1]
+            self.pending = True
+        return chunk.replace(b"\r\n", b"\n")
+
+    def flush(self):
+        """
+        :return: a CR still held back once the transfer has ended
+        """
+        if self.pending:
+            self.pending = False
+            return b"\r"
+        return b""
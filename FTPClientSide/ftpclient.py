@@ -4,7 +4,20 @@
 import socket
 import sys
 import re
+import os
+import time
+import glob
+import heapq
+import netrc
+import fnmatch
+import argparse
+import threading
+import zlib
+import hashlib
+from contextlib import contextmanager
 from logger import Logger
+from linereader import LineReader
+from compression import compressor, inflate
 
 """
 Author: Andrea Mathew
@@ -19,12 +32,26 @@ class ClientSocketConnection:
     ClientSocketConnection handles sending and receiving data from the client
     """
 
-    def __init__(self, host, logfilename="logs.txt", port=21):
+    def __init__(self, host, logfilename="logs.txt", port=21, exitonerror=True):
+        """
+        Create connection and connect to the server
+        :param host: server address
+        :param logfilename: file the session is logged to
+        :param port: server control port
+        :param exitonerror: exit the program when connecting or sending fails, False raises socket.error instead
+        """
         self.host = host
+        self.exitonerror = exitonerror
         self.logfilename = logfilename
         self.port = port
         self.datasocket = None
+        # user logged in on this connection, set by ConnectionPool
+        self.username = None
+        # transfer mode last set with MODE, "S" or "Z"
+        self.mode = "S"
         self.logger = Logger(logfilename)
+        # print server replies to the terminal
+        self.verbose = True
         self.ipv4 = False
         self.ipv6 = False
         try:
@@ -38,6 +65,8 @@ class ClientSocketConnection:
             try:
                 host_ip = socket.gethostbyname(host)
             except socket.gaierror:
+                if not self.exitonerror:
+                    raise
                 print ("There was an error resolving the host")
                 sys.exit()
             # Connect to server
@@ -45,6 +74,8 @@ class ClientSocketConnection:
                 self.clientsocket.connect((host_ip, port))
                 self.logger.connecting(host)
             except socket.error as e:
+                if not self.exitonerror:
+                    raise
                 print(e)
                 sys.exit(0)
 
@@ -64,8 +95,11 @@ class ClientSocketConnection:
                 self.clientsocket.connect((host_ip, port))
                 self.logger.connecting(host)
             except socket.error as e:
+                if not self.exitonerror:
+                    raise
                 print(e)
                 sys.exit(0)
+        self.reader = LineReader(self.clientsocket)
 
     def connected(self):
         """
@@ -95,21 +129,177 @@ class ClientSocketConnection:
             self.clientsocket.sendall(command.encode())
             self.logger.sent(command)
         except socket.error as e:
-            print(e)
+            if not self.exitonerror:
+                raise
+            # stderr, batch mode keeps stdout for the output of ls and pwd
+            print(e, file=sys.stderr)
             sys.exit(0)
 
     def receive(self):
         """
-        Receive data from the server, decode, and log message
+        Receive one reply from the server, decode, and log message
+        Multi-line replies ("xyz-" ... "xyz ") are returned as one string,
+        replies that arrived together stay buffered for the next call
         :return: decoded server response
         """
         try:
-            serverdata = self.clientsocket.recv(4096)
-            self.logger.received(serverdata.decode())
-            print(serverdata.decode()[:-1])
-            return serverdata.decode()
-        except socket.error as e:
-            print(e)
+            line = self.reader.readline()
+            serverdata = line
+            if line[3:4] == "-":
+                code = line[:3]
+                while line and not (line[:3] == code and line[3:4] == " "):
+                    line = self.reader.readline()
+                    serverdata += line
+            self.logger.received(serverdata)
+            if self.verbose:
+                print(serverdata[:-1])
+            return serverdata
+        except (socket.error, ValueError) as e:
+            # ValueError: reply line too long or not UTF-8
+            print(e, file=sys.stderr)
+
+
+class ConnectionPool:
+    """
+    Logged in control connections kept open for reuse, keyed by (host, port, user)
+    A connection idle for longer than "checkafter" seconds is checked with NOOP before it is handed out
+    and one idle for longer than "maxidle" seconds is closed
+    """
+
+    def __init__(self, logfilename="logs.txt", maxidle=60.0, checkafter=5.0, maxperkey=8):
+        """
+        Create pool
+        :param logfilename: log file the connections write to
+        :param maxidle: seconds an unused connection is kept
+        :param checkafter: seconds unused after which a connection is checked with NOOP
+        :param maxperkey: unused connections kept per key, extra ones are closed
+        """
+        self.logfilename = logfilename
+        self.maxidle = maxidle
+        self.checkafter = checkafter
+        self.maxperkey = maxperkey
+        # (host, port, user) -> list of (connection, time released)
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, host, port, username, password):
+        """
+        Hands out an idle connection for the key, or opens and logs in a new one
+        :param host: server address
+        :param port: server control port
+        :param username: user to login as
+        :param password: password of the user
+        :return: logged in ClientSocketConnection that does not print replies
+        """
+        key = (host, port, username)
+        self.evict()
+        while True:
+            with self.lock:
+                connections = self.idle.get(key)
+                if not connections:
+                    break
+                (connection, released) = connections.pop()
+            if time.monotonic() - released < self.checkafter or self.alive(connection):
+                return connection
+            connection.close()
+        return self.login(host, port, username, password)
+
+    def release(self, connection, reusable=True):
+        """
+        Returns a connection to the pool
+        :param connection: connection from acquire
+        :param reusable: False when the connection is in an unknown state and has to be closed
+        :return: none
+        """
+        if reusable:
+            key = (connection.host, connection.port, connection.username)
+            with self.lock:
+                connections = self.idle.setdefault(key, [])
+                if len(connections) < self.maxperkey:
+                    connections.append((connection, time.monotonic()))
+                    connection = None
+        if connection is not None:
+            connection.close()
+        self.evict()
+
+    @contextmanager
+    def session(self, host, port, username, password):
+        """
+        Borrows a connection for a with block, it is closed instead of returned if the block fails
+        :return: logged in ClientSocketConnection
+        """
+        connection = self.acquire(host, port, username, password)
+        try:
+            yield connection
+        except BaseException:
+            self.release(connection, False)
+            raise
+        self.release(connection)
+
+    def login(self, host, port, username, password):
+        """
+        Opens a control connection and logs in
+        :return: logged in ClientSocketConnection that does not print replies
+        """
+        connection = ClientSocketConnection(host, self.logfilename, port, exitonerror=False)
+        connection.verbose = False
+        connection.username = username
+        connection.receive()
+        connection.send("USER " + username + "\r\n")
+        connection.receive()
+        connection.send("PASS " + password + "\r\n")
+        response = connection.receive()
+        if response is None or response[:3] != "230":
+            connection.close()
+            raise socket.error("login failed on extra connection: %s" % response)
+        # files are written byte for byte, so transfers must not convert line endings
+        connection.send("TYPE I" + "\r\n")
+        connection.receive()
+        return connection
+
+    def alive(self, connection):
+        """
+        Health check with NOOP
+        :param connection: idle connection
+        :return: True if the server answered 200
+        """
+        try:
+            connection.clientsocket.settimeout(self.checkafter)
+            connection.clientsocket.sendall(b"NOOP\r\n")
+            response = connection.reader.readline()
+            connection.clientsocket.settimeout(None)
+            return response[:3] == "200"
+        except socket.error:
+            return False
+
+    def evict(self):
+        """
+        Closes connections idle for longer than maxidle
+        :return: none
+        """
+        now = time.monotonic()
+        expired = []
+        with self.lock:
+            for (key, connections) in self.idle.items():
+                while connections and now - connections[0][1] > self.maxidle:
+                    expired.append(connections.pop(0)[0])
+        for connection in expired:
+            connection.close()
+
+    def closeall(self):
+        """
+        Sends QUIT on every idle connection and closes it
+        :return: none
+        """
+        with self.lock:
+            connections = [connection for entries in self.idle.values() for (connection, released) in entries]
+            self.idle = {}
+        for connection in connections:
+            try:
+                connection.clientsocket.sendall(b"QUIT\r\n")
+            except socket.error:
+                pass
+            connection.close()
 
 
 class ServerStream:
@@ -123,6 +313,19 @@ class ServerStream:
         self.username = "username"
         self.password = "password"
         self.commands = ["user", "pass", "pwd", "cd", "ls", "exit", "stor", "retr", "pasv", "port"]
+        # connections and retries used by mget and mput
+        self.transferconnections = 4
+        self.transferretries = 2
+        # logged in connections reused by pget, mget and mput
+        self.pool = ConnectionPool(clientsocket.logfilename)
+        # deflate data connections with MODE Z, toggled with "compress"
+        self.compression = False
+        self.deflatelevel = 6
+        # compare XSHA256 of the server's copy after every get and put, toggled with "verify"
+        self.verify = False
+        # batch mode runs a script without printing replies or progress
+        self.batch = False
+        self.failures = 0
 
     def runprotocol(self):
         """
@@ -151,6 +354,68 @@ class ServerStream:
             else:
                 self.handleusercommand(usercommand)
 
+    def runbatch(self, script):
+        """
+        Logs in with the stored credentials and runs every command of a script, stopping at the first failure
+        Blank lines and lines starting with # are skipped
+        :param script: iterable of command lines, such as an open file or sys.stdin
+        :return: exit status, 0 if every command succeeded, 1 if a command failed, 2 if login or the connection failed
+        """
+        self.batch = True
+        self.socket.verbose = False
+        try:
+            self.socket.receive()
+            self.socket.send("USER " + self.username + "\r\n")
+            self.socket.receive()
+            self.socket.send("PASS " + self.password + "\r\n")
+            response = self.socket.receive()
+            if response is None or response[:3] != "230":
+                self.fail("login failed: %s" % (response or "connection closed").strip())
+                return 2
+            self.runbinary()
+            for line in script:
+                usercommand = line.strip()
+                if usercommand == "" or usercommand.startswith("#"):
+                    continue
+                if usercommand == "quit" or usercommand == "exit":
+                    break
+                self.handleusercommand(usercommand)
+                if self.failures:
+                    break
+            self.runquit()
+            self.socket.logger.quit()
+        except SystemExit:
+            # ClientSocketConnection exits when the control connection fails
+            return 2
+        return 1 if self.failures else 0
+
+    def report(self, message):
+        """
+        Prints progress and summaries, which batch mode leaves out
+        :param message: text to print
+        :return: none
+        """
+        if not self.batch:
+            print(message)
+
+    def fail(self, message):
+        """
+        Prints an error and counts it, batch mode stops at the first one
+        :param message: error text or exception
+        :return: none
+        """
+        self.failures += 1
+        print(message, file=sys.stderr if self.batch else sys.stdout)
+
+    def checkreply(self, response):
+        """
+        Counts a failure for a missing reply or a 4xx/5xx reply
+        :param response: reply from receive
+        :return: response
+        """
+        if response is None or response[:1] not in ("1", "2", "3"):
+            self.fail((response or "control connection lost").strip())
+        return response
 
     def handleusercommand(self, usercommand):
         """
@@ -168,8 +433,8 @@ class ServerStream:
         cmdargs = ["cd", "put", "get"]
         if cmd in cmdargs:
             if len(usercommand.split()) < 2:
-                print("usage:  <cmd> <arg>")
-                self.ftpprompt()
+                self.fail("usage:  <cmd> <arg>")
+                return
             arg = (usercommand.split())[1]
             self.parsecommandargs(cmd, arg)
         # commands that could be either
@@ -181,8 +446,40 @@ class ServerStream:
             else:
                 arg = (usercommand.split())[1]
                 self.parsecommandargs(cmd, arg)
-        if cmd not in ["pwd", "passive", "cd", "put", "get", "ls"]:
-            print("?Invalid command")
+        # get split over several data connections, optional connection count
+        if cmd == "pget":
+            args = usercommand.split()
+            if len(args) < 2 or (len(args) > 2 and not args[2].isdigit()):
+                self.fail("usage:  pget <file> [connections]")
+            elif len(args) > 2:
+                self.runpget(args[1], int(args[2]))
+            else:
+                self.runpget(args[1])
+        # batch transfers with glob patterns
+        if cmd in ["mget", "mput"]:
+            patterns = usercommand.split()[1:]
+            if len(patterns) == 0:
+                self.fail("usage:  %s <pattern> [pattern ...]" % cmd)
+            elif cmd == "mget":
+                self.runmget(patterns)
+            else:
+                self.runmput(patterns)
+        if cmd == "compress":
+            self.compression = not self.compression
+            self.report("Compression %s." % ("on" if self.compression else "off"))
+        if cmd == "verify":
+            self.verify = not self.verify
+            self.report("Checksum verification %s." % ("on" if self.verify else "off"))
+        if cmd == "parallel":
+            args = usercommand.split()
+            if len(args) != 2 or not args[1].isdigit() or int(args[1]) < 1:
+                self.fail("usage:  parallel <connections>")
+            else:
+                self.transferconnections = int(args[1])
+                self.report("mget/mput use %d connections." % self.transferconnections)
+        if cmd not in ["pwd", "passive", "cd", "put", "get", "ls", "pget", "mget", "mput", "parallel",
+                       "compress", "verify"]:
+            self.fail("?Invalid command")
 
     def parsecommand(self, cmd):
         """
@@ -216,6 +513,8 @@ class ServerStream:
         elif cmd == "get":
             filename = arg
             self.runretr(filename)
+        elif cmd == "ls":
+            self.runlist(arg)
 
     def enterusername(self):
         """
@@ -224,9 +523,8 @@ class ServerStream:
         """
         # Read in username and send to server
         self.socket.receive()
-        user = "USER " + input("Enter user: ") + "\r\n"
-        self.username = user
-        self.socket.send(self.username)
+        self.username = input("Enter user: ")
+        self.socket.send("USER " + self.username + "\r\n")
         self.socket.receive()
 
     def enterpassword(self):
@@ -234,14 +532,22 @@ class ServerStream:
         Prompts user to enter password to login, sends PASS command to server
         :return: none
         """
-        password = "PASS " + input("Enter password: ") + "\r\n"
-        self.password = password
-        self.socket.send(self.password)
+        self.password = input("Enter password: ")
+        self.socket.send("PASS " + self.password + "\r\n")
         if (self.socket.receive())[:3] == "530":
             print("Incorrect Credentials")
             sys.exit(0)
+        self.runbinary()
 
 
+    def runbinary(self):
+        """
+        Sends TYPE I, get and put write and send files byte for byte so the server must not convert line endings
+        :return: none
+        """
+        self.socket.send("TYPE I" + "\r\n")
+        self.checkreply(self.socket.receive())
+
     def runcwd(self, path):
         """
         Sends CWD command to server
@@ -249,7 +555,7 @@ class ServerStream:
         :return:
         """
         self.socket.send("CWD " + path + "\r\n")
-        self.socket.receive()
+        self.checkreply(self.socket.receive())
 
 
     def runpwd(self):
@@ -258,7 +564,10 @@ class ServerStream:
         :return: none
         """
         self.socket.send("PWD" + "\r\n")
-        self.socket.receive()
+        response = self.checkreply(self.socket.receive())
+        if self.batch and response is not None and response[:3] == "257":
+            # the directory is the output of the command
+            print(response[4:].split(" is the current directory")[0].strip())
 
 
     def runlist(self, path=None):
@@ -267,36 +576,11 @@ class ServerStream:
         :param path: path to list if passed in
         :return: none
         """
-        if self.socket.ipv4 == True:
-            # Send PASV
-            response227 = self.runpasv()
-            # Parse out IP address and host to use
-            # 227 Entering Passive Mode (10,246,251,93,133,171).
-            rawdata = response227[response227.find("(") + 1:response227.find(")")]
-            ip = self.parseip(rawdata)
-            port = self.parseport(rawdata)
-            # Send list through connection
-            # Open data socket with info from pasv response
-            if path is None:
-                self.socket.send("LIST" + "\r\n")
-            else:
-                self.socket.send("LIST " + path + "\r\n")
-            self.datasocket = ClientSocketConnection(ip, "ds.txt", port)
-            self.socket.receive()
-            self.datasocket.receive()
-            self.datasocket.close()
-            self.socket.receive()
-        else:
-            response229 = self.runepsv()
-            # Parse port number from response
-            port = response229[response229.find("(|||") + 4:response229.find("|)")]
-            # Open data socket with port number and same ip
-            self.socket.send("LIST " + "\r\n")
-            self.datasocket = ClientSocketConnection(self.socket.host, "ds.txt", int(port))
-            self.socket.receive()
-            self.datasocket.receive()
-            self.datasocket.close()
-            self.socket.receive()
+        try:
+            for name in self.listnames(self.socket, path):
+                print(name)
+        except (socket.error, zlib.error) as e:
+            self.fail(e)
 
     def parseip(self, rawdata):
         """
@@ -384,22 +668,10 @@ class ServerStream:
         :param filename: string file name of file to send to server
         :return: none
         """
-        # Send PASV
-        response227 = self.runpasv()
-        # Parse out IP address and host to use
-        # 227 Entering Passive Mode (10,246,251,93,133,171).
-        rawdata = response227[response227.find("(") + 1:response227.find(")")]
-        ip = self.parseip(rawdata)
-        port = self.parseport(rawdata)
-        # Send STOR through connection
-        # Open data socket with info from pasv response
-        self.socket.send("STOR " + filename + "\r\n")
-        # Send contents of file, opposite of how retr is working
-        # open file, get file data, send file data through data socket
-        self.datasocket = ClientSocketConnection(ip, "ds.txt", port)
-        self.socket.receive()
-        self.datasocket.close()
-        self.socket.receive()
+        try:
+            self.putfile(self.socket, filename)
+        except (socket.error, OSError, ValueError, zlib.error) as e:
+            self.fail(e)
 
     def runretr(self, filename):
         """
@@ -407,50 +679,511 @@ class ServerStream:
         :param filename: string file name of file to get from server
         :return:
         """
-        response227 = self.runpasv()
-        rawdata = response227[response227.find("(") + 1:response227.find(")")]
-        ip = self.parseip(rawdata)
-        port = self.parseport(rawdata)
-        # Send STOR through connection
-        # Open data socket with info from pasv response
-        self.socket.send("RETR " + filename + "\r\n")
-        self.datasocket = ClientSocketConnection(ip, "ds.txt", port)
-        # Data socket returns file data
-        filedata = self.datasocket.receive()
-        # open file and write data
-        receivedfile = open(filename, "w+")
-        receivedfile.write(filedata)
-        self.datasocket.close()
-        self.socket.receive()  # 150 response
-        self.socket.receive()
+        try:
+            self.getfile(self.socket, filename)
+        except (socket.error, OSError, ValueError, zlib.error) as e:
+            self.fail(e)
+
+    def opensession(self):
+        """
+        Borrows another logged in control connection to the server from the pool
+        :return: context manager giving a ClientSocketConnection that does not print replies
+        """
+        return self.pool.session(self.socket.host, self.socket.port, self.username, self.password)
+
+    def passiveconnect(self, session):
+        """
+        Sends PASV (EPSV for IPv6) on a session and connects to the data port it returns
+        :param session: logged in ClientSocketConnection
+        :return: connected data socket
+        """
+        if session.ipv6:
+            session.send("EPSV" + "\r\n")
+            response = session.receive()
+            if response is None or response[:3] != "229":
+                raise socket.error("EPSV failed: %s" % response)
+            port = int(response[response.find("(|||") + 4:response.find("|)")])
+            return socket.create_connection((session.host, port))
+        session.send("PASV" + "\r\n")
+        response = session.receive()
+        if response is None or response[:3] != "227":
+            raise socket.error("PASV failed: %s" % response)
+        rawdata = response[response.find("(") + 1:response.find(")")]
+        return socket.create_connection((self.parseip(rawdata), self.parseport(rawdata)))
+
+    def runpget(self, filename, segments=4):
+        """
+        Downloads a file over several data connections at once
+        The file is split into byte ranges, each range is fetched on its own logged in
+        connection with REST and RETR and written into place with os.pwrite
+        The ranges go into "<filename>.part", which replaces the file only once every range arrived
+        :param filename: string file name of file to get from server
+        :param segments: number of parallel connections
+        :return: none
+        """
+        self.socket.send("SIZE " + filename + "\r\n")
+        response = self.socket.receive()
+        if response is None or response[:3] != "213":
+            self.report("Server did not report a size, using get")
+            self.runretr(filename)
+            return
+        size = int(response.split()[1])
+        # ranges under 1 MB are not worth an extra connection and login
+        segments = max(1, min(segments, size // (1 << 20)))
+        start = time.time()
+        partname = filename + ".part"
+        errors = []
+        try:
+            filefd = os.open(partname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        except OSError as e:
+            self.fail(e)
+            return
+        complete = False
+        try:
+            # reserve the whole file up front so segments can be written in any order
+            if hasattr(os, "posix_fallocate") and size > 0:
+                os.posix_fallocate(filefd, 0, size)
+            else:
+                os.ftruncate(filefd, size)
+            segmentsize = size // segments
+            threads = []
+            for x in range(segments):
+                offset = x * segmentsize
+                length = segmentsize if x < segments - 1 else size - offset
+                thread = threading.Thread(target=self.fetchsegment, args=(filename, filefd, offset, length, errors))
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
+            complete = not errors
+        except OSError as e:
+            # no room for the file, nothing was fetched yet
+            errors.append(e)
+        finally:
+            os.close(filefd)
+        try:
+            if complete:
+                os.replace(partname, filename)
+            else:
+                # a preallocated file with holes must not be left looking complete
+                os.unlink(partname)
+        except OSError as e:
+            errors.append(e)
+        elapsed = max(time.time() - start, 0.000001)
+        if errors:
+            self.fail("pget failed: %s" % errors[0])
+        else:
+            self.report("%d bytes received in %.2f secs (%.4f MB/s) over %d connections" % (
+                size, elapsed, size / elapsed / 1e6, segments))
+
+    def fetchsegment(self, filename, filefd, offset, length, errors):
+        """
+        Fetches one byte range of a file on its own connection, run in a thread by runpget
+        :param filename: string file name of file to get from server
+        :param filefd: descriptor of the local file
+        :param offset: first byte of the range
+        :param length: number of bytes in the range
+        :param errors: list failures are appended to
+        :return: none
+        """
+        try:
+            with self.opensession() as session:
+                # ranges are counted in file bytes, so they are always fetched uncompressed
+                self.setmode(session, "S")
+                dsocket = self.passiveconnect(session)
+                try:
+                    session.send("REST %d\r\n" % offset)
+                    self.expectreply(session, "350")
+                    session.send("RETR " + filename + "\r\n")
+                    self.expectreply(session, "150")
+                    buffer = bytearray(65536)
+                    view = memoryview(buffer)
+                    position = offset
+                    remaining = length
+                    while remaining > 0:
+                        received = dsocket.recv_into(buffer, min(len(buffer), remaining))
+                        if received == 0:
+                            raise socket.error("data connection closed at byte %d" % position)
+                        os.pwrite(filefd, view[:received], position)
+                        position += received
+                        remaining -= received
+                finally:
+                    # closing early ends the server's send for every range but the last one
+                    dsocket.close()
+                # 226, or 426 when the range ended before the file did
+                if session.receive() is None:
+                    raise socket.error("control connection lost")
+        except (socket.error, OSError, ValueError) as e:
+            errors.append(e)
+
+    def expectreply(self, session, code):
+        """
+        Reads a reply on a session and checks its code
+        :param session: logged in ClientSocketConnection
+        :param code: expected three digit code, or its first digit
+        :return: reply text
+        """
+        response = session.receive()
+        if response is None or not response.startswith(code):
+            raise socket.error("unexpected reply: %s" % response)
+        return response
+
+    def listnames(self, session, path=None):
+        """
+        Lists a server directory on a session
+        :param session: logged in ClientSocketConnection
+        :param path: directory to list, the current directory if None
+        :return: list of names
+        """
+        return self.listlines(session, "LIST", path)
+
+    def listfacts(self, session, path=None):
+        """
+        Lists a server directory with MLSD on a session, which gives the type and size of every entry at once
+        :param session: logged in ClientSocketConnection
+        :param path: directory to list, the current directory if None
+        :return: list of (name, dict of lowercase fact name -> value)
+        """
+        entries = []
+        for line in self.listlines(session, "MLSD", path):
+            (facts, separator, name) = line.partition(" ")
+            if not separator:
+                continue
+            entries.append((name, dict(fact.partition("=")[::2] for fact in facts.lower().split(";") if fact)))
+        return entries
+
+    def listlines(self, session, command, path=None):
+        """
+        Reads a directory listing on a session
+        :param session: logged in ClientSocketConnection
+        :param command: "LIST" or "MLSD"
+        :param path: directory to list, the current directory if None
+        :return: list of lines
+        """
+        self.setmode(session)
+        dsocket = self.passiveconnect(session)
+        chunks = []
+        try:
+            if path is None:
+                session.send(command + "\r\n")
+            else:
+                session.send(command + " " + path + "\r\n")
+            self.expectreply(session, "150")
+            while True:
+                data = dsocket.recv(65536)
+                if not data:
+                    break
+                chunks.append(data)
+        finally:
+            dsocket.close()
+        self.expectreply(session, "226")
+        listing = b"".join(chunks)
+        if session.mode == "Z":
+            listing = zlib.decompress(listing)
+        return [name for name in listing.decode().split("\r\n") if name != ""]
+
+    def getfile(self, session, filename):
+        """
+        Downloads one file on a session
+        :param session: logged in ClientSocketConnection
+        :param filename: string file name of file to get from server
+        :return: none
+        """
+        self.setmode(session)
+        dsocket = self.passiveconnect(session)
+        try:
+            session.send("RETR " + filename + "\r\n")
+            self.expectreply(session, "150")
+            buffer = bytearray(65536)
+            view = memoryview(buffer)
+            decompressor = zlib.decompressobj() if session.mode == "Z" else None
+            # hashed while it is written so the file is not read back
+            digest = hashlib.sha256() if self.verify else None
+            with open(filename, "wb") as receivedfile:
+                while True:
+                    received = dsocket.recv_into(buffer)
+                    if received == 0:
+                        break
+                    pieces = [view[:received]] if decompressor is None else inflate(decompressor, view[:received])
+                    for piece in pieces:
+                        receivedfile.write(piece)
+                        if digest is not None:
+                            digest.update(piece)
+            if decompressor is not None and not decompressor.eof:
+                raise zlib.error("compressed stream ended early")
+        finally:
+            dsocket.close()
+        self.expectreply(session, "226")
+        if digest is not None:
+            self.verifyfile(session, filename, digest.hexdigest())
+
+    def putfile(self, session, filename):
+        """
+        Uploads one file on a session
+        :param session: logged in ClientSocketConnection
+        :param filename: string file name of file to send to server
+        :return: none
+        """
+        self.setmode(session)
+        dsocket = self.passiveconnect(session)
+        try:
+            session.send("STOR " + os.path.basename(filename) + "\r\n")
+            self.expectreply(session, "150")
+            with open(filename, "rb") as sentfile:
+                if session.mode == "S":
+                    dsocket.sendfile(sentfile)
+                else:
+                    deflate = compressor(filename, self.deflatelevel)
+                    while True:
+                        chunk = sentfile.read(262144)
+                        if not chunk:
+                            break
+                        dsocket.sendall(deflate.compress(chunk))
+                    dsocket.sendall(deflate.flush())
+        finally:
+            dsocket.close()
+        self.expectreply(session, "226")
+        if self.verify:
+            digest = hashlib.sha256()
+            with open(filename, "rb") as sentfile:
+                while True:
+                    chunk = sentfile.read(1048576)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+            self.verifyfile(session, os.path.basename(filename), digest.hexdigest())
+
+    def verifyfile(self, session, filename, localdigest):
+        """
+        Compares the server's SHA-256 of a file with the local one
+        :param session: logged in ClientSocketConnection
+        :param filename: file name on the server
+        :param localdigest: hex SHA-256 of the local copy
+        :return: none, raises ValueError when they differ
+        """
+        session.send("XSHA256 " + filename + "\r\n")
+        response = self.expectreply(session, "250")
+        remotedigest = response[4:].strip()
+        if remotedigest.lower() != localdigest:
+            raise ValueError("checksum mismatch for %s: local %s, server %s" % (filename, localdigest,
+                                                                               remotedigest.lower()))
+
+    def setmode(self, session, mode=None):
+        """
+        Sends MODE on a session when it is not in the wanted mode yet
+        :param session: logged in ClientSocketConnection
+        :param mode: "S" or "Z", by default "Z" when compression is on
+        :return: none
+        """
+        if mode is None:
+            mode = "Z" if self.compression else "S"
+        if session.mode != mode:
+            session.send("MODE " + mode + "\r\n")
+            self.expectreply(session, "200")
+            session.mode = mode
+
+    def runmget(self, patterns):
+        """
+        Downloads every file in the server directory matching one of the glob patterns
+        :param patterns: list of glob patterns
+        :return: none
+        """
+        scheduler = TransferScheduler(self, self.transferconnections, self.transferretries)
+        verbose = self.socket.verbose
+        self.socket.verbose = False
+        try:
+            # one listing gives every size, instead of a SIZE round trip per file
+            for (name, facts) in self.listfacts(self.socket):
+                # directories and links are skipped
+                if facts.get("type") != "file":
+                    continue
+                if any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns):
+                    scheduler.add(self.getfile, name, int(facts.get("size", 0)))
+        except (socket.error, zlib.error) as e:
+            self.fail(e)
+            return
+        finally:
+            self.socket.verbose = verbose
+        scheduler.run()
+
+    def runmput(self, patterns):
+        """
+        Uploads every local file matching one of the glob patterns
+        :param patterns: list of glob patterns
+        :return: none
+        """
+        scheduler = TransferScheduler(self, self.transferconnections, self.transferretries)
+        for pattern in patterns:
+            for filename in glob.glob(pattern):
+                if os.path.isfile(filename):
+                    scheduler.add(self.putfile, filename, os.path.getsize(filename))
+        scheduler.run()
 
     def runquit(self):
         '''
         Sends QUIT command to server, disconnects and exits ftp prompt
         :return:
         '''
+        self.pool.closeall()
         self.socket.send("QUIT" + "\r\n")
         self.socket.receive()
 
 
+class TransferScheduler:
+    """
+    Runs queued transfers on connections borrowed from the ServerStream's pool, smallest files first
+    A failed transfer closes its connection and is queued again up to the retry limit
+    """
+
+    def __init__(self, stream, connections=4, retries=2):
+        """
+        Create scheduler
+        :param stream: ServerStream whose credentials the connections log in with
+        :param connections: number of transfers run at once
+        :param retries: times a failed transfer is tried again
+        """
+        self.stream = stream
+        self.connections = connections
+        self.retries = retries
+        # heap of (size, order, transfer function, file name, attempts)
+        self.queue = []
+        self.order = 0
+        self.lock = threading.Lock()
+        self.done = []
+        self.failed = []
+
+    def add(self, transfer, filename, size):
+        """
+        Queues a transfer
+        :param transfer: ServerStream.getfile or ServerStream.putfile
+        :param filename: file to transfer
+        :param size: file size in bytes, smaller files run first
+        :return: none
+        """
+        heapq.heappush(self.queue, (size, self.order, transfer, filename, 0))
+        self.order += 1
+
+    def next(self):
+        """
+        :return: the smallest queued transfer, None once the queue is empty
+        """
+        with self.lock:
+            if not self.queue:
+                return None
+            return heapq.heappop(self.queue)
+
+    def run(self):
+        """
+        Runs every queued transfer and prints a summary
+        :return: none
+        """
+        if not self.queue:
+            self.stream.report("No files matched.")
+            return
+        start = time.time()
+        workers = []
+        for x in range(min(self.connections, len(self.queue))):
+            worker = threading.Thread(target=self.work)
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join()
+        elapsed = max(time.time() - start, 0.000001)
+        total = sum(size for (filename, size) in self.done)
+        self.stream.report("%d files, %d bytes in %.2f secs (%.4f MB/s), %d failed" % (
+            len(self.done), total, elapsed, total / elapsed / 1e6, len(self.failed)))
+        for (filename, error) in self.failed:
+            self.stream.fail("failed: %s: %s" % (filename, error))
+
+    def work(self):
+        """
+        Worker thread, takes transfers until the queue is empty
+        :return: none
+        """
+        while True:
+            item = self.next()
+            if item is None:
+                break
+            (size, order, transfer, filename, attempts) = item
+            try:
+                with self.stream.opensession() as session:
+                    transfer(session, filename)
+                with self.lock:
+                    self.done.append((filename, size))
+                    self.stream.report("%s: %d bytes" % (filename, size))
+            except (socket.error, OSError, ValueError, zlib.error) as e:
+                with self.lock:
+                    if attempts < self.retries:
+                        heapq.heappush(self.queue, (size, order, transfer, filename, attempts + 1))
+                    else:
+                        self.failed.append((filename, e))
+
+
+def credentials(host, netrcfile=None):
+    """
+    Looks up batch mode credentials, FTP_USER and FTP_PASSWORD in the environment come first,
+    then the machine entry for the host in a netrc file
+    :param host: server address
+    :param netrcfile: netrc file to read, ~/.netrc if None
+    :return: (user, password), None if neither has them
+    """
+    if os.environ.get("FTP_USER") is not None:
+        return (os.environ["FTP_USER"], os.environ.get("FTP_PASSWORD", ""))
+    try:
+        entry = netrc.netrc(netrcfile).authenticators(host)
+    except (OSError, netrc.NetrcParseError) as e:
+        if netrcfile is not None:
+            print(e, file=sys.stderr)
+        return None
+    if entry is None:
+        return None
+    return (entry[0], entry[2] or "")
+
+
 def main():
     """
     Parses user input and created client socket to start FTP protocol
     :return:
     """
-    # Create SocketConnection
-    if (len(sys.argv) < 3):
-        print("TO RUN: ftpclient.py <host> <logfile> <port>")
-    # All arguments passed in
-    elif (len(sys.argv) == 4):
-        clientsocketconnection = ClientSocketConnection(sys.argv[1], sys.argv[2], int(sys.argv[3]))
-    else:
-        clientsocketconnection = ClientSocketConnection(sys.argv[1], sys.argv[2])
+    parser = argparse.ArgumentParser(description="FTP client")
+    parser.add_argument("host", help="server address")
+    parser.add_argument("logfile", help="file the session is logged to")
+    parser.add_argument("port", nargs="?", type=int, default=21, help="server control port")
+    parser.add_argument("-b", "--batch", metavar="SCRIPT",
+                        help="run the commands in SCRIPT (- for stdin) without prompting and exit with a status code")
+    parser.add_argument("--netrc", metavar="FILE", help="netrc file with batch mode credentials (default ~/.netrc)")
+    options = parser.parse_args()
+
+    if options.batch is None:
+        # Create SocketConnection
+        clientsocketconnection = ClientSocketConnection(options.host, options.logfile, options.port)
+        if (clientsocketconnection.connected):
+            # Start FTP protocol
+            serverStream = ServerStream(clientsocketconnection)
+            serverStream.runprotocol()
+        return
 
-    if (clientsocketconnection.connected):
-        # Start FTP protocol
-        serverStream = ServerStream(clientsocketconnection)
-        serverStream.runprotocol()
+    login = credentials(options.host, options.netrc)
+    if login is None:
+        print("No credentials: set FTP_USER and FTP_PASSWORD or add the host to a netrc file", file=sys.stderr)
+        sys.exit(2)
+    try:
+        clientsocketconnection = ClientSocketConnection(options.host, options.logfile, options.port)
+    except SystemExit:
+        sys.exit(2)
+    serverStream = ServerStream(clientsocketconnection)
+    (serverStream.username, serverStream.password) = login
+    if options.batch == "-":
+        status = serverStream.runbatch(sys.stdin)
+    else:
+        try:
+            script = open(options.batch, "r")
+        except OSError as e:
+            print(e, file=sys.stderr)
+            sys.exit(2)
+        with script:
+            status = serverStream.runbatch(script)
+    sys.exit(status)
 
 
 if __name__ == "__main__":